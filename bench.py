@@ -0,0 +1,659 @@
+"""
+Нагрузочный тест бота без выхода в сеть.
+
+VK API и Telegram Bot API подменяются локальными заглушками: запросы
+two.py проходят через настоящие пул токенов, лимиты частоты, повторы
+и execute, а на месте HTTP отвечает FakeVk с заданной задержкой,
+лимитом запросов в секунду и объёмом лайков. Генератор нагрузки
+ведёт N чатов одновременно через обработчики handle_text
+(или async_handle_text в режиме --mode async).
+
+Примеры:
+    python bench.py --chats 50 --jobs 2
+    python bench.py --mode async --chats 500 --scenario activity,likers --vk-latency 0.1
+    python bench.py --save bench.json                 # запомнить результат
+    python bench.py --baseline bench.json             # код выхода 1 при регрессии
+
+Токены, базы и порты для теста выставляются здесь и не берутся из .env.
+Остальные настройки two.py (ANALYSIS_POSTS, BULK_POSTS, CACHE_SIZE...)
+можно задать переменными окружения как обычно.
+"""
+import os
+import sys
+import re
+import json
+import time
+import random
+import argparse
+import asyncio
+import threading
+import itertools
+import tracemalloc
+from array import array
+from bisect import bisect_left
+from collections import Counter, deque
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+two = None  # модуль бота, импортируется после настройки окружения
+
+
+# === ЗАГЛУШКА VK API ===
+class FakeVkError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class FakeVk:
+    """
+    Данные и поведение VK API: группы club1..clubN с постами, лайки
+    и репосты пользователей id1..idM, лимит запросов в секунду на токен.
+    Ответы — словари {'response': ...} или {'error': ...}, как у api.vk.com.
+    """
+    EXECUTE_LIMIT = 25
+    EXECUTE_CALL = re.compile(r'API\.([\w.]+)\((\{.*?\})\)')
+
+    def __init__(self, groups=5, posts=200, likes=300, users=100000, latency=0.05, jitter=0.5,
+                 rps_limit=3, seed=1):
+        self.groups = groups
+        self.posts = posts
+        self.likes = likes
+        self.users = users
+        self.latency = latency
+        self.jitter = jitter
+        self.rps_limit = rps_limit
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.now = int(time.time())
+        self.lock = threading.Lock()
+        self.windows = {}  # токен -> времена запросов за последнюю секунду
+        self.requests = Counter()  # HTTP-запросы по методам
+        self.calls = Counter()  # вызовы методов, включая вызовы внутри execute
+        self.rate_limited = 0
+        self.likers = {}  # (группа, пост) -> (лайкнувшие, сделавшие репост), отсортированные array
+        for group in range(1, groups + 1):
+            for post in range(1, posts + 1):
+                self.likers[(group, post)] = self._make_likers(group, post)
+
+    def _make_likers(self, group, post):
+        rng = random.Random(f"{self.seed}:{group}:{post}")
+        count = min(self.users, rng.randint(self.likes // 2, self.likes * 3 // 2))
+        liked = sorted(rng.sample(range(1, self.users + 1), count))
+        copied = sorted(rng.sample(liked, count // 20))
+        return array('l', liked), array('l', copied)
+
+    def delay(self):
+        return self.latency * (1 + self.jitter * (2 * self.random.random() - 1))
+
+    def random_liker(self, rng, group):
+        liked = self.likers[(group, rng.randint(1, self.posts))][0]
+        return liked[rng.randrange(len(liked))] if liked else rng.randint(1, self.users)
+
+    # --- HTTP ---
+    def handle(self, method, values):
+        token = values.get('access_token')
+        with self.lock:
+            self.requests[method] += 1
+            if not self._allow(token):
+                self.rate_limited += 1
+                return self._error(6, "Too many requests per second")
+        if method == 'execute':
+            return self._execute(values.get('code', ''))
+        with self.lock:
+            self.calls[method] += 1
+        try:
+            return {'response': self.call(method, values)}
+        except FakeVkError as e:
+            return self._error(e.code, str(e))
+
+    def _allow(self, token):
+        if not self.rps_limit:
+            return True
+        now = time.monotonic()
+        window = self.windows.setdefault(token, deque())
+        while window and now - window[0] >= 1:
+            window.popleft()
+        if len(window) >= self.rps_limit:
+            return False
+        window.append(now)
+        return True
+
+    @staticmethod
+    def _error(code, message):
+        return {'error': {'error_code': code, 'error_msg': message, 'request_params': []}}
+
+    def _execute(self, code):
+        found = self.EXECUTE_CALL.findall(code)
+        if len(found) > self.EXECUTE_LIMIT:
+            return self._error(13, "Too many API calls")
+        results, errors = [], []
+        for method, params in found:
+            with self.lock:
+                self.calls[method] += 1
+            try:
+                results.append(self.call(method, json.loads(params)))
+            except FakeVkError as e:
+                results.append(False)
+                errors.append({'method': method, 'error_code': e.code, 'error_msg': str(e)})
+        response = {'response': results}
+        if errors:
+            response['execute_errors'] = errors
+        return response
+
+    # --- методы ---
+    def call(self, method, values):
+        handler = getattr(self, 'm_' + method.replace('.', '_'), None)
+        if handler is None:
+            raise FakeVkError(3, f"Unknown method passed: {method}")
+        return handler(values)
+
+    def _group(self, value):
+        group = abs(int(value))
+        if not 1 <= group <= self.groups:
+            raise FakeVkError(100, "One of the parameters specified was missing or invalid: owner_id")
+        return group
+
+    def _post(self, values):
+        group, post = self._group(values['owner_id']), int(values['item_id'])
+        if not 1 <= post <= self.posts:
+            raise FakeVkError(100, "One of the parameters specified was missing or invalid: item_id")
+        return self.likers[(group, post)]
+
+    def _user(self, user_id):
+        return {'id': user_id, 'first_name': f"Имя{user_id}", 'last_name': f"Фамилия{user_id}",
+                'screen_name': f"id{user_id}"}
+
+    def m_utils_resolveScreenName(self, values):
+        name = str(values['screen_name']).lower()
+        match = re.fullmatch(r'(club|public|id)(\d+)', name)
+        if not match:
+            return []
+        kind, number = match.group(1), int(match.group(2))
+        if kind == 'id':
+            return {'type': 'user', 'object_id': number} if 1 <= number <= self.users else []
+        return {'type': 'group', 'object_id': number} if 1 <= number <= self.groups else []
+
+    def m_users_get(self, values):
+        users = []
+        for name in str(values.get('user_ids', '')).split(','):
+            name = name.strip().lower()
+            number = name[2:] if name.startswith('id') else name
+            if number.isdigit() and 1 <= int(number) <= self.users:
+                users.append(self._user(int(number)))
+        return users
+
+    def m_groups_getById(self, values):
+        groups = str(values.get('group_id') or values.get('group_ids', '')).split(',')
+        return [{'id': group, 'name': f"Группа {group}", 'screen_name': f"club{group}", 'type': 'group'}
+                for group in map(self._group, groups)]
+
+    def m_wall_get(self, values):
+        group = self._group(values['owner_id'])
+        offset, count = int(values.get('offset', 0)), min(int(values.get('count', 20)), 100)
+        items = []
+        for post in range(self.posts - offset, max(0, self.posts - offset - count), -1):
+            liked, copied = self.likers[(group, post)]
+            items.append({
+                'id': post, 'owner_id': -group, 'from_id': -group,
+                'date': self.now - (self.posts - post) * 3600,
+                'text': f"Пост {post}",
+                'likes': {'count': len(liked)},
+                'reposts': {'count': len(copied)},
+            })
+        return {'count': self.posts, 'items': items}
+
+    def m_likes_isLiked(self, values):
+        liked, copied = self._post(values)
+        user_id = int(values['user_id'])
+        contains = lambda ids: int(bool(ids) and bisect_left(ids, user_id) < len(ids) and
+                                   ids[bisect_left(ids, user_id)] == user_id)
+        return {'liked': contains(liked), 'copied': contains(copied)}
+
+    def m_likes_getList(self, values):
+        liked, copied = self._post(values)
+        ids = copied if values.get('filter') == 'copies' else liked
+        extended = int(values.get('extended', 0))
+        offset = int(values.get('offset', 0))
+        count = min(int(values.get('count', 100)), 100 if extended else 1000)
+        items = ids[offset:offset + count].tolist()
+        if extended:
+            items = [dict(self._user(user_id), type='profile') for user_id in items]
+        return {'count': len(ids), 'items': items}
+
+
+class FakeVkHttp:
+    """Вместо requests.Session у vk_api.VkApi: запрос уходит в FakeVk."""
+
+    def __init__(self, vk):
+        self.vk = vk
+
+    def post(self, url, data=None, **kwargs):
+        time.sleep(self.vk.delay())
+        return FakeHttpResponse(self.vk.handle(url.rsplit('/', 1)[-1], dict(data or {})))
+
+
+class FakeHttpResponse:
+    ok = True
+    status_code = 200
+    status = 200
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self, content_type=None):
+        return self.payload
+
+
+class FakeAiohttpSession:
+    """Вместо aiohttp.ClientSession у AsyncVkApi."""
+
+    def __init__(self, vk):
+        self.vk = vk
+
+    def post(self, url, data=None, **kwargs):
+        return FakeAiohttpRequest(self.vk, url, data)
+
+    async def close(self):
+        pass
+
+
+class FakeAiohttpRequest:
+    def __init__(self, vk, url, data):
+        self.vk = vk
+        self.url = url
+        self.data = data
+
+    async def __aenter__(self):
+        await asyncio.sleep(self.vk.delay())
+        response = self.vk.handle(self.url.rsplit('/', 1)[-1], dict(self.data or {}))
+        return SimpleNamespace(status=200, json=lambda content_type=None: _completed(response))
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+async def _completed(value):
+    return value
+
+
+# === ЗАГЛУШКА TELEGRAM ===
+class FakeTelegram:
+    """
+    Методы TeleBot, которыми пользуется two.py. Ответы не уходят
+    в Telegram, а считаются и передаются в JobTracker.
+    """
+
+    def __init__(self, tracker, latency=0.02):
+        self.tracker = tracker
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.messages = 0
+        self.edits = 0
+        self.documents = 0
+        self.document_bytes = 0
+
+    def _message(self, chat_id, text):
+        with self.lock:
+            self.messages += 1
+        self.tracker.message(chat_id, text)
+        return SimpleNamespace(message_id=next(self.ids), chat=SimpleNamespace(id=chat_id), text=text)
+
+    def _edit(self):
+        with self.lock:
+            self.edits += 1
+        return True
+
+    def _document(self, chat_id, document):
+        size = len(document.read())
+        with self.lock:
+            self.documents += 1
+            self.document_bytes += size
+        return SimpleNamespace(message_id=next(self.ids), chat=SimpleNamespace(id=chat_id))
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.latency)
+        return self._message(chat_id, text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        time.sleep(self.latency)
+        return self._edit()
+
+    def send_document(self, chat_id, document, **kwargs):
+        time.sleep(self.latency)
+        return self._document(chat_id, document)
+
+
+class AsyncFakeTelegram(FakeTelegram):
+    """То же для AsyncTeleBot."""
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._message(chat_id, text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._edit()
+
+    async def send_document(self, chat_id, document, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._document(chat_id, document)
+
+
+# === УЧЁТ ЗАДАЧ ===
+class JobTracker:
+    """
+    Время задачи — от сообщения, которое её запустило, до итогового
+    ответа бота: «✅ Готово», ошибки «❌» или отказа при переполненной очереди.
+    """
+    OUTCOMES = (("✅ Готово", 'ok'), ("❌", 'failed'), ("⚠️ Бот сейчас перегружен", 'rejected'))
+
+    def __init__(self, event_factory=threading.Event):
+        self.event_factory = event_factory
+        self.lock = threading.Lock()
+        self.running = {}  # chat_id -> (время запуска, событие завершения)
+        self.latencies = []
+        self.outcomes = Counter()
+
+    def start(self, chat_id):
+        event = self.event_factory()
+        with self.lock:
+            self.running[chat_id] = (time.perf_counter(), event)
+        return event
+
+    def message(self, chat_id, text):
+        outcome = next((name for prefix, name in self.OUTCOMES if text.startswith(prefix)), None)
+        if outcome is None:
+            return
+        with self.lock:
+            job = self.running.pop(chat_id, None)
+            if job is None:
+                return
+            self.outcomes[outcome] += 1
+            if outcome == 'ok':
+                self.latencies.append(time.perf_counter() - job[0])
+        job[1].set()
+
+    def timeout(self, chat_id):
+        with self.lock:
+            if self.running.pop(chat_id, None) is not None:
+                self.outcomes['timeout'] += 1
+
+
+# === ГЕНЕРАТОР НАГРУЗКИ ===
+SCENARIOS = ('activity', 'likers', 'top', 'bulk')
+
+
+def scenario_steps(scenario, rng, vk, bulk_size):
+    """Сообщения пользователя для сценария; последнее запускает долгую задачу."""
+    group = rng.randint(1, vk.groups)
+    group_link = f"https://vk.com/club{group}"
+    if scenario == 'activity':
+        return ["Начать анализ", group_link, f"https://vk.com/id{vk.random_liker(rng, group)}"]
+    if scenario == 'likers':
+        return ["Кто лайкнул пост", f"https://vk.com/wall-{group}_{rng.randint(1, vk.posts)}"]
+    if scenario == 'top':
+        return ["Рейтинг группы", group_link]
+    if scenario == 'bulk':
+        links = "\n".join(f"https://vk.com/id{vk.random_liker(rng, group)}" for _ in range(bulk_size))
+        return ["Массовая проверка", group_link, links]
+    raise ValueError(scenario)
+
+
+def make_message(chat_id, text):
+    return SimpleNamespace(
+        chat=SimpleNamespace(id=chat_id, type='private'),
+        from_user=SimpleNamespace(id=chat_id, username=f"bench{chat_id}"),
+        text=text,
+        content_type='text',
+        document=None,
+    )
+
+
+def run_chat(chat_id, args, vk, tracker):
+    rng = random.Random(chat_id)
+    for _ in range(args.jobs):
+        steps = scenario_steps(rng.choice(args.scenario), rng, vk, args.bulk_size)
+        for text in steps[:-1]:
+            two.handle_text(make_message(chat_id, text))
+        done = tracker.start(chat_id)
+        two.handle_text(make_message(chat_id, steps[-1]))
+        if not done.wait(args.timeout):
+            tracker.timeout(chat_id)
+
+
+async def async_run_chat(chat_id, args, vk, tracker):
+    rng = random.Random(chat_id)
+    for _ in range(args.jobs):
+        steps = scenario_steps(rng.choice(args.scenario), rng, vk, args.bulk_size)
+        for text in steps[:-1]:
+            await two.async_handle_text(make_message(chat_id, text))
+        done = tracker.start(chat_id)
+        await two.async_handle_text(make_message(chat_id, steps[-1]))
+        try:
+            await asyncio.wait_for(done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            tracker.timeout(chat_id)
+
+
+def patch_bot(telegram):
+    """Подменяет методы синхронного two.bot: через него идут и сводки владельцу."""
+    for name in ('send_message', 'edit_message_text', 'send_document'):
+        setattr(two.bot, name, getattr(telegram, name))
+
+
+def run_sync(args, vk, tracker):
+    telegram = FakeTelegram(tracker, args.tg_latency)
+    patch_bot(telegram)
+    threads = [threading.Thread(target=run_chat, args=(1000 + i, args, vk, tracker), daemon=True)
+               for i in range(args.chats)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return telegram
+
+
+async def run_async(args, vk, tracker):
+    telegram = AsyncFakeTelegram(tracker, args.tg_latency)
+    two.async_bot = telegram
+    patch_bot(FakeTelegram(tracker, args.tg_latency))  # сводки владельцу и в async-режиме идут через two.bot
+    two.avk_session = two.AsyncVkApi(two.vk_session, two.vk_session.api_version)
+    two.avk_session.session = FakeAiohttpSession(vk)
+    two.avk = two.avk_session.get_api()
+    two.async_job_slots = asyncio.Semaphore(two.ASYNC_JOB_LIMIT)
+    await asyncio.gather(*(async_run_chat(1000 + i, args, vk, tracker) for i in range(args.chats)))
+    return telegram
+
+
+# === ОТЧЁТ ===
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def collect_results(args, vk, tracker, telegram, elapsed, traced_peak):
+    jobs = sum(tracker.outcomes.values())
+    ran = jobs - tracker.outcomes['rejected']  # отклонённые задачи к VK почти не обращаются
+    requests = sum(vk.requests.values())
+    calls = sum(vk.calls.values())
+    latencies = tracker.latencies
+    return {
+        'mode': args.mode,
+        'chats': args.chats,
+        'scenarios': ",".join(args.scenario),
+        'jobs': jobs,
+        'ok': tracker.outcomes['ok'],
+        'failed': tracker.outcomes['failed'],
+        'rejected': tracker.outcomes['rejected'],
+        'timeout': tracker.outcomes['timeout'],
+        'elapsed': round(elapsed, 3),
+        'jobs_per_sec': round(tracker.outcomes['ok'] / elapsed, 3) if elapsed else 0.0,
+        'vk_rps': round(requests / elapsed, 2) if elapsed else 0.0,
+        'p50': round(percentile(latencies, 0.50), 3),
+        'p90': round(percentile(latencies, 0.90), 3),
+        'p99': round(percentile(latencies, 0.99), 3),
+        'max': round(max(latencies, default=0.0), 3),
+        'vk_requests_per_job': round(requests / ran, 2) if ran else 0.0,
+        'vk_calls_per_job': round(calls / ran, 2) if ran else 0.0,
+        'vk_rate_limited': vk.rate_limited,
+        'vk_requests': dict(vk.requests),
+        'tg_messages': telegram.messages,
+        'tg_edits': telegram.edits,
+        'tg_documents': telegram.documents,
+        'tg_document_mb': round(telegram.document_bytes / 1024 / 1024, 2),
+        'peak_traced_mb': round(traced_peak / 1024 / 1024, 1) if traced_peak is not None else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def format_results(r):
+    lines = [
+        f"Режим: {r['mode']}, чатов: {r['chats']}, сценарии: {r['scenarios']}",
+        f"Задачи: {r['jobs']} (успешно {r['ok']}, ошибок {r['failed']}, отклонено {r['rejected']}, "
+        f"по таймауту {r['timeout']}) за {r['elapsed']:.1f} с",
+        f"Пропускная способность: {r['jobs_per_sec']:.2f} задач/с, запросов VK: {r['vk_rps']:.1f}/с",
+        f"Время задачи: p50 {r['p50']:.2f} с, p90 {r['p90']:.2f} с, p99 {r['p99']:.2f} с, макс. {r['max']:.2f} с",
+        f"VK на задачу: {r['vk_requests_per_job']} HTTP-запросов, {r['vk_calls_per_job']} вызовов методов",
+        "Запросы VK: " + ", ".join(f"{method} {count}" for method, count in sorted(r['vk_requests'].items())),
+        f"Ошибки частоты VK (код 6): {r['vk_rate_limited']}",
+        f"Telegram: сообщений {r['tg_messages']}, правок {r['tg_edits']}, "
+        f"файлов {r['tg_documents']} ({r['tg_document_mb']} МБ)",
+    ]
+    memory = f"Память: пик RSS {r['peak_rss_mb']} МБ"
+    if r['peak_traced_mb'] is not None:
+        memory += f", пик выделений Python {r['peak_traced_mb']} МБ (tracemalloc)"
+    lines.append(memory)
+    return "\n".join(lines)
+
+
+# показатель -> True, если рост — это улучшение
+COMPARED = {'jobs_per_sec': True, 'p50': False, 'p99': False, 'vk_calls_per_job': False,
+            'peak_traced_mb': False, 'peak_rss_mb': False}
+
+
+def compare_results(baseline, current, tolerance):
+    """Строки о показателях, ухудшившихся больше чем на tolerance (доля)."""
+    regressions = []
+    for key, higher_is_better in COMPARED.items():
+        old, new = baseline.get(key), current.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{key}: {old} → {new} ({change:+.0%})")
+    return regressions
+
+
+# === ЗАПУСК ===
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на заглушках VK и Telegram")
+    parser.add_argument('--mode', choices=('sync', 'async'), default='sync', help="обработчики two.py")
+    parser.add_argument('--chats', type=int, default=20, help="одновременных чатов")
+    parser.add_argument('--jobs', type=int, default=2, help="задач подряд в каждом чате")
+    parser.add_argument('--scenario', default='activity,likers',
+                        help=f"сценарии через запятую, чаты выбирают их случайно: {', '.join(SCENARIOS)}")
+    parser.add_argument('--bulk-size', type=int, default=50, help="профилей в массовой проверке")
+    parser.add_argument('--groups', type=int, default=5, help="групп ВК в заглушке")
+    parser.add_argument('--posts', type=int, default=200, help="постов в каждой группе")
+    parser.add_argument('--likes', type=int, default=300, help="лайков на пост в среднем")
+    parser.add_argument('--users', type=int, default=100000, help="пользователей ВК")
+    parser.add_argument('--vk-latency', type=float, default=0.05, help="задержка ответа VK, сек")
+    parser.add_argument('--vk-limit', type=int, default=3, help="запросов в секунду на токен, дальше — ошибка 6; 0 — без лимита")
+    parser.add_argument('--vk-rps', type=float, help="лимит частоты в самом боте (VK_RPS), по умолчанию равен --vk-limit")
+    parser.add_argument('--tokens', type=int, default=1, help="токенов VK в пуле")
+    parser.add_argument('--tg-latency', type=float, default=0.02, help="задержка ответа Telegram, сек")
+    parser.add_argument('--workers', type=int, default=4, help="JOB_WORKERS")
+    parser.add_argument('--queue', type=int, default=1000, help="JOB_QUEUE_LIMIT")
+    parser.add_argument('--format', default='docx', help="REPORT_FORMAT: docx, csv, csv.gz или xlsx")
+    parser.add_argument('--timeout', type=float, default=300, help="сколько ждать одну задачу, сек")
+    parser.add_argument('--tracemalloc', action='store_true', help="считать пик выделений Python (замедляет работу)")
+    parser.add_argument('--metrics', action='store_true', help="вывести метрики бота после теста")
+    parser.add_argument('--save', help="сохранить результат в JSON")
+    parser.add_argument('--baseline', help="JSON прошлого запуска для сравнения")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимое ухудшение относительно --baseline")
+    args = parser.parse_args(argv)
+    args.scenario = [name.strip() for name in args.scenario.split(',') if name.strip()]
+    unknown = set(args.scenario) - set(SCENARIOS)
+    if unknown or not args.scenario:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown)) or '—'}")
+    if args.vk_rps is None:
+        args.vk_rps = args.vk_limit or 1000
+    return args
+
+
+def configure_environment(args):
+    """Окружение two.py до импорта: заглушечные токены, всё в памяти, без портов."""
+    os.environ.update({
+        'TELEGRAM_TOKEN': '123456:bench',
+        'VK_TOKENS': ",".join(f"bench{i}" for i in range(1, args.tokens + 1)),
+        'YOUR_CHAT_ID': '1',
+        'VK_RPS': str(args.vk_rps),
+        'JOB_WORKERS': str(args.workers),
+        'JOB_QUEUE_LIMIT': str(args.queue),
+        'REPORT_FORMAT': args.format,
+        'CACHE_DB': '',
+        'LIKE_INDEX_DB': '',
+        'STATE_DB': '',
+        'METRICS_PORT': '0',
+        'OWNER_REPORT_OVERFLOW': 'drop',
+    })
+
+
+def main(argv=None):
+    global two
+    args = parse_args(argv)
+    configure_environment(args)
+    import two as bot_module
+    two = bot_module
+
+    vk = FakeVk(args.groups, args.posts, args.likes, args.users, args.vk_latency, rps_limit=args.vk_limit)
+    for token in two.vk_session.tokens:
+        token.session.http = FakeVkHttp(vk)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    if args.mode == 'async':
+        tracker = JobTracker(asyncio.Event)
+        telegram = asyncio.run(run_async(args, vk, tracker))
+    else:
+        tracker = JobTracker()
+        telegram = run_sync(args, vk, tracker)
+    elapsed = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+
+    results = collect_results(args, vk, tracker, telegram, elapsed, traced_peak)
+    print(format_results(results))
+    if args.metrics:
+        print("\n" + two.metrics.summary())
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare_results(json.load(f), results, args.tolerance)
+        if regressions:
+            print("\n⚠️ Регрессия относительно " + args.baseline + ":\n" + "\n".join(regressions))
+            return 1
+        print("\nБез регрессий относительно " + args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,923 @@
 import os
+import sys
 import re
+import io
+import html
+import csv
+import gzip
+import json
+import zlib
+import queue
+import atexit
+import tempfile
+import pickle
+import sqlite3
+import math
+import random
+import time
+import bisect
+import operator
+import itertools
+import functools
+import contextlib
+import threading
+import multiprocessing
+import http.server
+import urllib.request
+from collections import Counter, OrderedDict, deque
+from array import array
 import vk_api
 from telebot import TeleBot, types
-from vk_api.exceptions import ApiError
+from vk_api.exceptions import ApiError, TOO_MANY_RPS_CODE
+from vk_api.vk_api import VkApiMethod
 from dotenv import load_dotenv
 import datetime
+import asyncio
 from docx import Document
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 
+try:  # нужны только для асинхронного режима (BOT_MODE=async)
+    import aiohttp
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError:
+    aiohttp = AsyncTeleBot = None
+
+try:  # ускоряет массовую проверку; без него считаем на чистом Python
+    import numpy as np
+except ImportError:
+    np = None
+
+try:  # нужен только для выгрузки в XLSX
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
 # === Загрузка переменных окружения ===
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 VK_TOKEN = os.getenv('VK_TOKEN')
+# несколько токенов через запятую; если не заданы — используется VK_TOKEN
+VK_TOKENS = [t.strip() for t in os.getenv('VK_TOKENS', VK_TOKEN or '').split(',') if t.strip()]
+VK_POOL_STRATEGY = os.getenv('VK_POOL_STRATEGY', 'least_loaded')  # или round_robin
+VK_TOKEN_COOLDOWN = int(os.getenv('VK_TOKEN_COOLDOWN', 60))
 YOUR_CHAT_ID = os.getenv('YOUR_CHAT_ID')
-
-if not TELEGRAM_TOKEN or not VK_TOKEN:
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling, async или webhook
+ASYNC_JOB_LIMIT = int(os.getenv('ASYNC_JOB_LIMIT', 500))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # внешний адрес для setWebhook; пусто — webhook настроен вручную
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # сверяется с X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 1))  # процессов-обработчиков
+VK_RPS = float(os.getenv('VK_RPS', 3))
+VK_MAX_RETRIES = int(os.getenv('VK_MAX_RETRIES', 4))
+CACHE_SIZE = int(os.getenv('CACHE_SIZE', 5000))
+CACHE_DB = os.getenv('CACHE_DB', '')  # путь к SQLite-файлу кэша; пусто — только память
+LIKE_INDEX_DB = os.getenv('LIKE_INDEX_DB', '')  # путь к SQLite-индексу лайков; пусто — только память
+# больше — старые записи удаляются; индекс в памяти по умолчанию держим маленьким
+LIKE_INDEX_MAX_MB = float(os.getenv('LIKE_INDEX_MAX_MB', 200 if LIKE_INDEX_DB else 20))
+LIKE_INDEX_MAX_AGE = float(os.getenv('LIKE_INDEX_MAX_AGE', 24 * 60 * 60))  # сек, пока запись с неизменными счётчиками считается верной
+STATE_DB = os.getenv('STATE_DB', '')  # SQLite-файл состояния диалогов, общий для процессов; пусто — память
+STATE_TTL = float(os.getenv('STATE_TTL', 24 * 60 * 60))  # сек, через сколько брошенный диалог забывается
+SETTINGS_TTL = float(os.getenv('SETTINGS_TTL', 90 * 24 * 60 * 60))  # сек для настроек чата (формат, глубина)
+STATE_MAX_CHATS = int(os.getenv('STATE_MAX_CHATS', 10000))
+OWNER_REPORT_INTERVAL = float(os.getenv('OWNER_REPORT_INTERVAL', 30))  # сек между сводками владельцу
+OWNER_REPORT_QUEUE = int(os.getenv('OWNER_REPORT_QUEUE', 1000))
+OWNER_REPORT_OVERFLOW = os.getenv('OWNER_REPORT_OVERFLOW', 'drop')  # drop или spill
+OWNER_REPORT_SPILL = os.getenv('OWNER_REPORT_SPILL', 'owner_reports.jsonl')
+ANALYSIS_POSTS = int(os.getenv('ANALYSIS_POSTS', 30))  # глубина анализа по умолчанию
+ANALYSIS_MAX_POSTS = int(os.getenv('ANALYSIS_MAX_POSTS', 2000))  # предел глубины, в том числе для диапазона дат
+BULK_MAX_USERS = int(os.getenv('BULK_MAX_USERS', 1000))
+BULK_FILE_LIMIT = 1024 * 1024  # максимальный размер файла со списком профилей
+BULK_POSTS = int(os.getenv('BULK_POSTS', 100))  # постов группы в массовой проверке (максимум wall.get)
+LEADERBOARD_POSTS = int(os.getenv('LEADERBOARD_POSTS', 100))  # постов в рейтинге группы
+LEADERBOARD_HOT_DAYS = float(os.getenv('LEADERBOARD_HOT_DAYS', 3))  # посты моложе — перепроверяются при обновлении
+REPORT_FORMAT = os.getenv('REPORT_FORMAT', 'docx')  # docx, csv, csv.gz или xlsx
+REPORT_SPILL_BYTES = int(os.getenv('REPORT_SPILL_BYTES', 20 * 1024 * 1024))  # крупнее — во временный файл
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_QUEUE_LIMIT = int(os.getenv('JOB_QUEUE_LIMIT', 20))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # порт для /metrics в формате Prometheus; 0 — выключено
+PROFILE_SLOW_SECONDS = float(os.getenv('PROFILE_SLOW_SECONDS', 0))  # профилировать задачи дольше; 0 — выключено
+
+if not TELEGRAM_TOKEN or not VK_TOKENS:
     print("Ошибка: не найдены токены в .env!")
     exit()
 
 bot = TeleBot(TELEGRAM_TOKEN)
-vk_session = vk_api.VkApi(token=VK_TOKEN)
+
+
+# === МЕТРИКИ И ПРОФИЛИРОВАНИЕ ===
+METRIC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # границы гистограмм времени, сек
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """
+    Счётчики и гистограммы времени с метками, в памяти процесса.
+    render() отдаёт их в текстовом формате Prometheus, summary() — кратко для /stats.
+    """
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счётчики по корзинам, сумма, количество]
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name):
+        """Декоратор: время каждого вызова в гистограмме name с меткой func."""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(name, func=func.__name__):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, func=func.__name__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render(self, gauges=()):
+        """Текст для Prometheus; gauges — [(имя, {метки}, значение)], снятые в момент запроса."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, [list(h[0]), h[1], h[2]]) for key, h in self.histograms.items())
+        lines, typed = [], set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), (counts, total, count) in histograms:
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for name, labels, value in gauges:
+            declare(name, "gauge")
+            lines.append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def percentile(self, counts, q):
+        """Верхняя граница корзины, в которую попадает q-я доля наблюдений."""
+        target, seen = q * sum(counts), 0
+        for bound, bucket in zip(self.buckets + (math.inf,), counts):
+            seen += bucket
+            if seen >= target:
+                return bound
+        return math.inf
+
+    def summary(self):
+        """Краткая сводка для владельца: по гистограммам — число, среднее и p95, по счётчикам — значения."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, [list(h[0]), h[1], h[2]]) for key, h in self.histograms.items())
+        lines, current = [], None
+        for (name, labels), (counts, total, count) in histograms:
+            if name != current:
+                current = name
+                lines.append(f"\n{name}:")
+            label = ", ".join(str(value) for _, value in labels) or "—"
+            p95 = self.percentile(counts, 0.95)
+            p95_text = f"≤{p95:g} с" if p95 != math.inf else f">{self.buckets[-1]} с"
+            lines.append(f"• {label}: {count} шт., ср. {total / count:.2f} с, p95 {p95_text}")
+        for (name, labels), value in counters:
+            if name != current:
+                current = name
+                lines.append(f"\n{name}:")
+            lines.append(f"• {', '.join(str(v) for _, v in labels) or '—'}: {value}")
+        return "\n".join(lines).strip()
+
+
+metrics = Metrics()
+
+
+def log_error(where, error):
+    """Печатает ошибку и учитывает её в метрике errors_total."""
+    print(f"{where}: {error}")
+    metrics.inc('errors_total', where=where, type=type(error).__name__)
+
+
+def _frame_stack(frame, depth=5):
+    places = []
+    while frame is not None and len(places) < depth:
+        places.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return " ← ".join(places)
+
+
+class SlowRequestProfiler:
+    """
+    Выборочный профилировщик медленных задач. Пока задача выполняется,
+    фоновый поток раз в interval секунд снимает стек её потока; если задача
+    шла дольше threshold секунд, самые частые стеки печатаются и
+    сохраняются для /stats. threshold = 0 — профилировщик выключен.
+    """
+
+    def __init__(self, threshold, interval=0.01, keep=5):
+        self.threshold = threshold
+        self.interval = interval
+        self.watched = {}  # id потока -> Counter стеков
+        self.reports = deque(maxlen=keep)
+        self.lock = threading.Lock()
+        self.started = False
+
+    @contextlib.contextmanager
+    def watch(self, label):
+        if not self.threshold:
+            yield
+            return
+        thread_id = threading.get_ident()
+        samples = Counter()
+        with self.lock:
+            nested = thread_id in self.watched  # внешняя задача уже профилируется
+            if not nested:
+                self.watched[thread_id] = samples
+            if not self.started:
+                self.started = True
+                threading.Thread(target=self._sample, name="slow-profiler", daemon=True).start()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if not nested:
+                with self.lock:
+                    del self.watched[thread_id]
+                elapsed = time.perf_counter() - started
+                if elapsed >= self.threshold:
+                    self._report(label, elapsed, samples)
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, samples in self.watched.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_frame_stack(frame)] += 1
+
+    def _report(self, label, elapsed, samples):
+        total = sum(samples.values()) or 1
+        lines = [f"🐢 {label}: {elapsed:.1f} с, снимков стека: {total}"]
+        for stack, count in samples.most_common(10):
+            lines.append(f"{count * 100 // total:3d}% {stack}")
+        report = "\n".join(lines)
+        print(report)
+        self.reports.append(report)
+        metrics.inc('slow_requests_total', func=label)
+
+
+slow_profiler = SlowRequestProfiler(PROFILE_SLOW_SECONDS)
+
+
+# === Ограничение частоты запросов к VK ===
+VK_RETRY_CODES = (6, 9)  # 6 — слишком много запросов в секунду, 9 — flood control
+VK_RETRY_BASE = 0.5      # базовая пауза перед повтором, сек
+VK_RETRY_CAP = 10        # максимальная пауза перед повтором, сек
+
+
+def vk_backoff(error, attempt):
+    """Пауза перед повтором с полным джиттером; при flood control ждём дольше."""
+    base = VK_RETRY_BASE * (4 if error is not None and error.code == 9 else 1)
+    return random.uniform(0, min(VK_RETRY_CAP, base * 2 ** attempt))
+
+
+class VkRateLimiter:
+    """
+    Token bucket на все запросы к VK от одного токена.
+    Считает, сколько времени вызовы простояли в ожидании.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def reserve(self):
+        """Занимает место под запрос и возвращает, сколько секунд нужно подождать."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.calls += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def backlog(self):
+        """Сколько секунд придётся ждать следующему запросу."""
+        with self.lock:
+            tokens = min(self.burst, self.tokens + (time.monotonic() - self.updated) * self.rate)
+            return (1 - tokens) / self.rate if tokens < 1 else 0.0
+
+    def retry_delay(self, error, attempt):
+        with self.lock:
+            self.retries += 1
+        return vk_backoff(error, attempt)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'retries': self.retries,
+                'total_wait': round(self.total_wait, 3),
+                'avg_wait': round(self.total_wait / self.calls, 4) if self.calls else 0.0,
+                'max_wait': round(self.max_wait, 3),
+            }
+
+
+class LimitedVkApi(vk_api.VkApi):
+    """
+    VkApi, у которого каждый запрос проходит через VkRateLimiter токена
+    и повторяется при ошибках 6 и 9.
+    """
+    RPS_DELAY = 0  # частоту ограничивает limiter, встроенная пауза vk_api не нужна
+
+    def __init__(self, *args, limiter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+        # встроенный обработчик ошибки 6 спит 0.5 с и повторяет запрос без ограничений —
+        # пусть ошибка доходит до цикла повторов в method()
+        self.error_handlers.pop(TOO_MANY_RPS_CODE, None)
+
+    def method(self, method, values=None, captcha_sid=None, captcha_key=None, raw=False):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                return super().method(method, values, captcha_sid=captcha_sid, captcha_key=captcha_key, raw=raw)
+            except ApiError as e:
+                metrics.inc('vk_errors_total', method=method, code=e.code)
+                if e.code not in VK_RETRY_CODES or attempt >= VK_MAX_RETRIES:
+                    raise
+                time.sleep(self.limiter.retry_delay(e, attempt))
+                attempt += 1
+
+
+# === Пул токенов VK ===
+# ошибки, после которых токен временно выводится из ротации, и множитель паузы:
+# 5 — токен отозван/недействителен, 29 — исчерпан дневной лимит метода, 6/9 — частота
+VK_TOKEN_ERRORS = {5: 10, 29: 10, 6: 1, 9: 2}
+
+
+class VkToken:
+    def __init__(self, token, rps):
+        self.token = token
+        self.limiter = VkRateLimiter(rps)
+        self.session = LimitedVkApi(token=token, limiter=self.limiter)
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.errors = {}
+
+    @property
+    def name(self):
+        return f"…{self.token[-4:]}"
+
+
+class VkTokenPool:
+    """
+    Пул сессий VK на нескольких токенах. Запросы раздаются наименее
+    загруженному токену (или по кругу), у каждого токена свой лимит частоты.
+    Токены с ошибками авторизации или лимитов отдыхают VK_TOKEN_COOLDOWN
+    секунд и затем автоматически возвращаются в ротацию.
+    """
+
+    def __init__(self, tokens, rps, strategy='least_loaded'):
+        self.tokens = [VkToken(token, rps) for token in tokens]
+        self.strategy = strategy
+        self.lock = threading.Lock()
+        self.next_index = 0
+
+    @property
+    def api_version(self):
+        return self.tokens[0].session.api_version
+
+    def pick(self, exclude=()):
+        with self.lock:
+            now = time.monotonic()
+            candidates = [t for t in self.tokens if t not in exclude] or self.tokens
+            available = [t for t in candidates if t.cooldown_until <= now]
+            if not available:
+                # все отдыхают — берём тот, что освободится раньше
+                available = [min(candidates, key=lambda t: t.cooldown_until)]
+
+            if self.strategy == 'round_robin':
+                token = available[self.next_index % len(available)]
+                self.next_index += 1
+            else:
+                token = min(available, key=lambda t: (t.in_flight, t.limiter.backlog()))
+            token.in_flight += 1
+            return token
+
+    def release(self, token):
+        with self.lock:
+            token.in_flight -= 1
+
+    def report_error(self, token, error):
+        """Учитывает ошибку токена; возвращает True, если запрос стоит повторить на другом."""
+        with self.lock:
+            token.errors[error.code] = token.errors.get(error.code, 0) + 1
+            if error.code not in VK_TOKEN_ERRORS:
+                return False
+            token.cooldown_until = time.monotonic() + VK_TOKEN_COOLDOWN * VK_TOKEN_ERRORS[error.code]
+            print(f"Токен VK {token.name} выведен из ротации (ошибка {error.code})")
+            return True
+
+    def method(self, method, values=None, captcha_sid=None, captcha_key=None, raw=False):
+        tried = []
+        while True:
+            token = self.pick(exclude=tried)
+            try:
+                with metrics.timer('vk_request_seconds', method=method):
+                    return token.session.method(method, values, captcha_sid=captcha_sid, captcha_key=captcha_key, raw=raw)
+            except ApiError as e:
+                tried.append(token)
+                if not self.report_error(token, e) or len(tried) >= len(self.tokens):
+                    raise
+            finally:
+                self.release(token)
+
+    def get_api(self):
+        return VkApiMethod(self)
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return [
+                {
+                    'token': t.name,
+                    'in_flight': t.in_flight,
+                    'cooldown': round(max(0.0, t.cooldown_until - now), 1),
+                    'errors': dict(t.errors),
+                    **t.limiter.stats(),
+                }
+                for t in self.tokens
+            ]
+
+
+vk_session = VkTokenPool(VK_TOKENS, VK_RPS, VK_POOL_STRATEGY)
 vk = vk_session.get_api()
 
-user_states = {}
+
+# === Кэш ответов VK ===
+CACHE_TTL = {
+    'screen_name': 24 * 60 * 60,  # короткие имена почти не меняются
+    'user': 60 * 60,
+    'group': 60 * 60,
+    'wall': 2 * 60,
+    'likes': 10 * 60,
+    'leaderboard': 7 * 24 * 60 * 60,  # рейтинг группы обновляется частями
+}
+
+
+class VkCache:
+    """
+    LRU-кэш с временем жизни записей по видам данных (CACHE_TTL).
+    Если задан путь к SQLite, записи дублируются на диск и после
+    перезапуска читаются оттуда. На диске хранится не больше max_size
+    записей, просроченные удаляются.
+    """
+    MISSING = object()
+    MEMORY_ONLY = {'likes'}  # списки лайкнувших переживают перезапуск в LikeIndex
+    PRUNE_EVERY = 100  # записей на диск между чистками таблицы
+
+    def __init__(self, max_size, ttl, db_path=''):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()  # (kind, key) -> (expires, value)
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.misses = {}
+        self.db = None
+        self.writes = 0
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "kind TEXT, key TEXT, value BLOB, expires REAL, PRIMARY KEY (kind, key))"
+            )
+            self._prune()
+            self.db.commit()
+
+    def get(self, kind, key, track=True):
+        """Возвращает значение или VkCache.MISSING. track=False — не учитывать в статистике."""
+        with self.lock:
+            now = time.time()
+            entry = self.items.get((kind, key))
+            if entry and entry[0] < now:
+                del self.items[(kind, key)]
+                entry = None
+            if entry is None and self.db is not None and kind not in self.MEMORY_ONLY:
+                row = self.db.execute(
+                    "SELECT value, expires FROM cache WHERE kind = ? AND key = ? AND expires >= ?",
+                    (kind, repr(key), now)
+                ).fetchone()
+                if row:
+                    entry = (row[1], pickle.loads(row[0]))
+                    self._put(kind, key, entry)
+            if entry is None:
+                if track:
+                    self.misses[kind] = self.misses.get(kind, 0) + 1
+                return self.MISSING
+            self.items.move_to_end((kind, key))
+            if track:
+                self.hits[kind] = self.hits.get(kind, 0) + 1
+            return entry[1]
+
+    def set(self, kind, key, value):
+        entry = (time.time() + self.ttl[kind], value)
+        with self.lock:
+            self._put(kind, key, entry)
+            if self.db is not None and kind not in self.MEMORY_ONLY:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO cache (kind, key, value, expires) VALUES (?, ?, ?, ?)",
+                    (kind, repr(key), pickle.dumps(value), entry[0])
+                )
+                self.writes += 1
+                if self.writes % self.PRUNE_EVERY == 0:
+                    self._prune()
+                self.db.commit()
+
+    def _prune(self):
+        """Удаляет с диска просроченные записи и те, что не влезают в max_size."""
+        self.db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+        self.db.execute(
+            "DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,)
+        )
+
+    def _put(self, kind, key, entry):
+        self.items[(kind, key)] = entry
+        self.items.move_to_end((kind, key))
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                kind: {'hits': self.hits.get(kind, 0), 'misses': self.misses.get(kind, 0)}
+                for kind in self.ttl
+            } | {'size': len(self.items)}
+
+
+vk_cache = VkCache(CACHE_SIZE, CACHE_TTL, CACHE_DB)
+
+
+def cached(kind, key, fetch):
+    """Берёт значение из кэша или получает его через fetch() и запоминает."""
+    value = vk_cache.get(kind, key)
+    if value is VkCache.MISSING:
+        value = fetch()
+        vk_cache.set(kind, key, value)
+    return value
+
+
+async def cached_async(kind, key, fetch):
+    # кэш на SQLite читаем и пишем в пуле потоков, чтобы не держать event loop
+    value = await _cache_call(vk_cache.get, kind, key)
+    if value is VkCache.MISSING:
+        value = await fetch()
+        await _cache_call(vk_cache.set, kind, key, value)
+    return value
+
+
+async def _cache_call(method, *args):
+    if vk_cache.db is None:
+        return method(*args)
+    return await asyncio.to_thread(method, *args)
+
+# === ЛОКАЛЬНЫЙ ИНДЕКС ЛАЙКОВ ===
+def _pack_ids(ids):
+    """Отсортированные id -> сжатые разности соседних значений."""
+    deltas = array('q', map(operator.sub, ids, itertools.chain((0,), ids)))
+    return zlib.compress(deltas.tobytes())
+
+
+def _unpack_ids(blob):
+    deltas = array('q')
+    deltas.frombytes(zlib.decompress(blob))
+    return array('q', itertools.accumulate(deltas))
+
+
+def _post_counts(post):
+    return post.get('likes', {}).get('count', 0), post.get('reposts', {}).get('count', 0)
+
+
+class LikeIndex:
+    """
+    Индекс в SQLite: пост -> лайкнувшие и репостнувшие (упакованные
+    массивы id) и обратная таблица пользователь -> посты группы, которые
+    он лайкал или репостил. Для каждого поста хранится время выгрузки
+    и счётчики из wall.get: запись со старыми счётчиками перевыгружается,
+    с прежними — используется до max_age. При превышении max_bytes
+    удаляются самые давние записи.
+    """
+    ROW_BYTES = 16  # примерный размер строки обратной таблицы
+    LIKED, COPIED = 1, 2
+
+    def __init__(self, path, max_bytes, max_age):
+        self.path = path or ':memory:'
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS posts ("
+            "owner_id INTEGER, post_id INTEGER, likes_count INTEGER, reposts_count INTEGER, "
+            "likes BLOB, copies BLOB, fetched REAL, PRIMARY KEY (owner_id, post_id));"
+            "CREATE INDEX IF NOT EXISTS posts_fetched ON posts (fetched);"
+            "CREATE TABLE IF NOT EXISTS audience ("
+            "owner_id INTEGER, user_id INTEGER, post_id INTEGER, kinds INTEGER, "
+            "PRIMARY KEY (owner_id, user_id, post_id)) WITHOUT ROWID;"
+        )
+        self.size = (
+            self.db.execute("SELECT COALESCE(SUM(LENGTH(likes) + LENGTH(copies)), 0) FROM posts").fetchone()[0]
+            + self.db.execute("SELECT COUNT(*) FROM audience").fetchone()[0] * self.ROW_BYTES
+        )
+        self.hits = 0
+        self.compactions = 0
+
+    def get(self, owner_id, post):
+        """{'likes': array, 'copies': array}, если запись ещё годится, иначе None."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT likes_count, reposts_count, likes, copies, fetched FROM posts WHERE owner_id = ? AND post_id = ?",
+                (owner_id, post['id'])
+            ).fetchone()
+        if row is None:
+            return None
+        age = time.time() - row[4]
+        if age >= AUDIENCE_TTL and ((row[0], row[1]) != _post_counts(post) or age >= self.max_age):
+            return None
+        self.hits += 1
+        return {'likes': _unpack_ids(row[2]), 'copies': _unpack_ids(row[3])}
+
+    def _audience_rows(self, owner_id, post_id, likes, copies):
+        kinds = dict.fromkeys(likes, self.LIKED)
+        for user_id in copies:
+            kinds[user_id] = kinds.get(user_id, 0) | self.COPIED
+        return [(owner_id, user_id, post_id, kind) for user_id, kind in kinds.items()]
+
+    def _delete(self, owner_id, post_id, likes_blob, copies_blob):
+        """Удаляет пост и его строки обратной таблицы; возвращает освобождённые байты."""
+        users = set(_unpack_ids(likes_blob)) | set(_unpack_ids(copies_blob))
+        self.db.executemany("DELETE FROM audience WHERE owner_id = ? AND user_id = ? AND post_id = ?",
+                            ((owner_id, user_id, post_id) for user_id in users))
+        self.db.execute("DELETE FROM posts WHERE owner_id = ? AND post_id = ?", (owner_id, post_id))
+        return len(likes_blob) + len(copies_blob) + len(users) * self.ROW_BYTES
+
+    def put(self, owner_id, post, audience):
+        likes, copies = _pack_ids(audience['likes']), _pack_ids(audience['copies'])
+        rows = self._audience_rows(owner_id, post['id'], audience['likes'], audience['copies'])
+        with self.lock:
+            old = self.db.execute(
+                "SELECT likes, copies FROM posts WHERE owner_id = ? AND post_id = ?", (owner_id, post['id'])
+            ).fetchone()
+            if old:
+                self.size -= self._delete(owner_id, post['id'], *old)
+            self.db.execute(
+                "INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (owner_id, post['id'], *_post_counts(post), likes, copies, time.time())
+            )
+            self.db.executemany("INSERT INTO audience VALUES (?, ?, ?, ?)", rows)
+            self.db.commit()
+            self.size += len(likes) + len(copies) + len(rows) * self.ROW_BYTES
+            if self.size > self.max_bytes:
+                self._compact()
+
+    def liked_posts(self, owner_id, user_id, exclude=()):
+        """
+        Проиндексированные посты группы, которые пользователь лайкнул
+        или репостнул: [(post_id, liked, copied)], новые сначала.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT post_id, kinds FROM audience WHERE owner_id = ? AND user_id = ? ORDER BY post_id DESC",
+                (owner_id, user_id)
+            ).fetchall()
+        return [
+            (post_id, int(bool(kinds & self.LIKED)), int(bool(kinds & self.COPIED)))
+            for post_id, kinds in rows if post_id not in exclude
+        ]
+
+    def _compact(self):
+        """Удаляет самые давние записи, пока индекс не сожмётся до 80% лимита."""
+        target = self.max_bytes * 0.8
+        for owner_id, post_id in self.db.execute("SELECT owner_id, post_id FROM posts ORDER BY fetched").fetchall():
+            if self.size <= target:
+                break
+            blobs = self.db.execute("SELECT likes, copies FROM posts WHERE owner_id = ? AND post_id = ?",
+                                    (owner_id, post_id)).fetchone()
+            self.size -= self._delete(owner_id, post_id, *blobs)
+        self.db.commit()
+        if self.path != ':memory:':
+            self.db.execute("VACUUM")
+        self.compactions += 1
+
+    def stats(self):
+        with self.lock:
+            posts = self.db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+        return {'posts': posts, 'bytes': self.size, 'hits': self.hits, 'compactions': self.compactions}
+
+
+like_index = LikeIndex(LIKE_INDEX_DB, LIKE_INDEX_MAX_MB * 1024 * 1024, LIKE_INDEX_MAX_AGE)
+
+# === СОСТОЯНИЕ ДИАЛОГОВ ===
+class StateStore:
+    """
+    Состояние по chat_id с интерфейсом словаря (get, [], pop, in).
+    Записи хранятся компактным JSON; запись, которую не меняли дольше
+    ttl секунд, считается брошенной и пропадает, а сверх max_size
+    вытесняются дольше всех не менявшиеся.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def get(self, chat_id, default=None):
+        value = self._load(chat_id)
+        return default if value is None else value
+
+    def __getitem__(self, chat_id):
+        value = self._load(chat_id)
+        if value is None:
+            raise KeyError(chat_id)
+        return value
+
+    def __contains__(self, chat_id):
+        return self._load(chat_id) is not None
+
+    def pop(self, chat_id, *default):
+        value = self._load(chat_id)
+        if value is None:
+            if default:
+                return default[0]
+            raise KeyError(chat_id)
+        self._delete(chat_id)
+        return value
+
+
+def _pack_state(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+class MemoryStateStore(StateStore):
+    def __init__(self, ttl, max_size):
+        super().__init__(ttl, max_size)
+        self.items = OrderedDict()  # chat_id -> (время изменения, JSON), старые в начале
+        self.lock = threading.Lock()
+
+    def _load(self, chat_id):
+        with self.lock:
+            entry = self.items.get(chat_id)
+            if entry is None:
+                return None
+            if entry[0] < time.time() - self.ttl:
+                del self.items[chat_id]
+                return None
+            return json.loads(entry[1])
+
+    def __setitem__(self, chat_id, value):
+        with self.lock:
+            self.items[chat_id] = (time.time(), _pack_state(value))
+            self.items.move_to_end(chat_id)
+            expired = time.time() - self.ttl
+            while self.items and (len(self.items) > self.max_size or next(iter(self.items.values()))[0] < expired):
+                self.items.popitem(last=False)
+
+    def _delete(self, chat_id):
+        with self.lock:
+            self.items.pop(chat_id, None)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class SqliteStateStore(StateStore):
+    """Состояние в SQLite: его видят все процессы-обработчики и оно переживает перезапуск."""
+    EVICT_EVERY = 100  # записей между чистками
+
+    def __init__(self, path, table, ttl, max_size):
+        super().__init__(ttl, max_size)
+        self.table = table
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (chat_id INTEGER PRIMARY KEY, value TEXT, touched REAL)")
+        self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_touched ON {table} (touched)")
+        with self.lock:
+            self._evict()
+
+    def _load(self, chat_id):
+        with self.lock:
+            row = self.db.execute(
+                f"SELECT value FROM {self.table} WHERE chat_id = ? AND touched >= ?",
+                (chat_id, time.time() - self.ttl)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def __setitem__(self, chat_id, value):
+        with self.lock:
+            self.db.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+                            (chat_id, _pack_state(value), time.time()))
+            self.writes += 1
+            if self.writes % self.EVICT_EVERY == 0:
+                self._evict()
+            self.db.commit()
+
+    def _delete(self, chat_id):
+        with self.lock:
+            self.db.execute(f"DELETE FROM {self.table} WHERE chat_id = ?", (chat_id,))
+            self.db.commit()
+
+    def _evict(self):
+        self.db.execute(f"DELETE FROM {self.table} WHERE touched < ?", (time.time() - self.ttl,))
+        self.db.execute(
+            f"DELETE FROM {self.table} WHERE chat_id IN "
+            f"(SELECT chat_id FROM {self.table} ORDER BY touched DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,)
+        )
+        self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute(f"SELECT COUNT(*) FROM {self.table} WHERE touched >= ?",
+                                   (time.time() - self.ttl,)).fetchone()[0]
+
+
+def make_state_store(table, ttl):
+    if STATE_DB:
+        return SqliteStateStore(STATE_DB, table, ttl, STATE_MAX_CHATS)
+    return MemoryStateStore(ttl, STATE_MAX_CHATS)
+
+
+user_states = make_state_store('states', STATE_TTL)  # chat_id -> шаг диалога и собранные данные
+report_formats = make_state_store('formats', SETTINGS_TTL)  # chat_id -> формат файла с результатами
+analysis_depths = make_state_store('depths', SETTINGS_TTL)  # chat_id -> {'count': N} или {'since': ts, 'until': ts}
 
 # === ФУНКЦИИ СОЗДАНИЯ ОТЧЁТОВ ===
 
@@ -54,14 +949,44 @@ def create_doxc_report(groups_data, filename="vk_analysis_report.docx"):
     return filename
 
 
+_base_documents = {}  # заголовок -> байты готового документа со стилями и шапкой
+
+
+def _base_document(heading):
+    """
+    Документ с заголовком из заранее собранной заготовки: шаблон python-docx
+    и шапка строятся один раз, дальше документ только читается из памяти.
+    """
+    base = _base_documents.get(heading)
+    if base is None:
+        doc = Document()
+        title = doc.add_heading(heading, level=1)
+        title.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        doc.add_paragraph()
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        base = _base_documents[heading] = buffer.getvalue()
+    return Document(io.BytesIO(base))
+
+
+def _save_report(doc, filename_prefix):
+    """
+    Сохраняет документ в память (или во временный файл, если он больше
+    REPORT_SPILL_BYTES). Возвращает (имя файла для Telegram, открытый файл).
+    """
+    filename = f"{filename_prefix}_{datetime.datetime.now().strftime('%d-%m-%Y_%H-%M')}.docx"
+    report_file = tempfile.SpooledTemporaryFile(max_size=REPORT_SPILL_BYTES, suffix=".docx")
+    doc.save(report_file)
+    report_file.seek(0)
+    return filename, report_file
+
+
 def create_activity_docx(user_info, posts_data, filename_prefix="Активность"):
     """
-    Создаёт .docx отчёт по активности пользователя в группе
+    Создаёт .docx отчёт по активности пользователя в группе.
+    Возвращает (имя файла, файл в памяти)
     """
-    doc = Document()
-    title = doc.add_heading('Анализ активности пользователя', level=1)
-    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    doc.add_paragraph()
+    doc = _base_document('Анализ активности пользователя')
 
     # Инфо о пользователе и группе
     p = doc.add_paragraph()
@@ -82,13 +1007,16 @@ def create_activity_docx(user_info, posts_data, filename_prefix="Активно
     total = len(posts_data)
     liked = sum(1 for p in posts_data if p["liked"])
     reposted = sum(1 for p in posts_data if p["reposted"])
+    checked = sum(1 for p in posts_data if p.get("checked", True))
     
     doc.add_heading("📊 Сводка", level=2)
     doc.add_paragraph(f"Всего постов: {total}")
+    if checked < total:
+        doc.add_paragraph(f"Не удалось проверить: {total - checked}")
     doc.add_paragraph(f"Лайков: {liked}")
     doc.add_paragraph(f"Репостов: {reposted}")
-    if total > 0:
-        activity_percent = (liked + reposted) / total * 100
+    if checked > 0:
+        activity_percent = (liked + reposted) / checked * 100
         doc.add_paragraph(f"Активность: {activity_percent:.1f}%")
     else:
         doc.add_paragraph("Активность: 0%")
@@ -100,38 +1028,98 @@ def create_activity_docx(user_info, posts_data, filename_prefix="Активно
         p = doc.add_paragraph()
         p.add_run(f"{i}. {item['date']}").bold = True
         p.add_run(f"\nСсылка: {item['link']}")
-        p.add_run(f"\nЛайк: {'✅ Да' if item['liked'] else '❌ Нет'}")
-        p.add_run(f"\nРепост: {'✅ Да' if item['reposted'] else '❌ Нет'}")
+        p.add_run(f"\nЛайк: {activity_mark(item, 'liked', '✅ Да', '❌ Нет', '❔ Не проверен')}")
+        p.add_run(f"\nРепост: {activity_mark(item, 'reposted', '✅ Да', '❌ Нет', '❔ Не проверен')}")
         doc.add_paragraph()
 
-    filename = f"{filename_prefix}_{datetime.datetime.now().strftime('%d-%m-%Y_%H-%M')}.docx"
-    doc.save(filename)
-    return filename
+    return _save_report(doc, filename_prefix)
 
 
 def create_likers_docx(post_info, likers_data, filename_prefix="Лайкнувшие"):
     """
-    Создаёт .docx отчёт по лайкнувшим пост
+    Создаёт .docx отчёт по лайкнувшим пост.
+    likers_data может быть генератором — строки добавляются по мере поступления.
+    Возвращает (имя файла, файл в памяти)
     """
-    doc = Document()
-    title = doc.add_heading('Список лайкнувших пост', level=1)
-    title.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    doc.add_paragraph()
+    doc = _base_document('Список лайкнувших пост')
 
     doc.add_paragraph("🔗 Ссылка на пост: ").add_run(post_info["link"]).underline = True
-    doc.add_paragraph(f"👥 Всего лайков: {len(likers_data)}")
+    total_paragraph = doc.add_paragraph("👥 Всего лайков: ")
     doc.add_paragraph()
 
     doc.add_heading("📝 Список пользователей", level=2)
-    for i, user in enumerate(likers_data, 1):
+    count = 0
+    for count, user in enumerate(likers_data, 1):
         p = doc.add_paragraph()
-        p.add_run(f"{i}. ").bold = True
+        p.add_run(f"{count}. ").bold = True
         p.add_run(user["name"])
         p.add_run(f" — {user['link']}")
+    total_paragraph.add_run(str(post_info.get("count", count)))
 
-    filename = f"{filename_prefix}_{datetime.datetime.now().strftime('%d-%m-%Y_%H-%M')}.docx"
-    doc.save(filename)
-    return filename
+    return _save_report(doc, filename_prefix)
+
+
+# === Табличные отчёты (CSV / XLSX) ===
+REPORT_FORMATS = {"DOCX": "docx", "CSV": "csv", "CSV (gzip)": "csv.gz"}
+if openpyxl is not None:
+    REPORT_FORMATS["XLSX"] = "xlsx"
+
+LIKERS_COLUMNS = ("№", "VK ID", "Имя", "Ссылка")
+ACTIVITY_COLUMNS = ("№", "Дата", "Ссылка", "Лайк", "Репост")
+
+
+def format_title(fmt):
+    return next((title for title, value in REPORT_FORMATS.items() if value == fmt), fmt.upper())
+
+
+def create_table_report(fmt, columns, rows, filename_prefix):
+    """
+    Потоково пишет строки в CSV (при fmt='csv.gz' — сжатый) или в XLSX
+    в режиме write_only: в памяти не держится ничего, кроме текущей строки.
+    Возвращает (имя файла, открытый файл).
+    """
+    filename = f"{filename_prefix}_{datetime.datetime.now().strftime('%d-%m-%Y_%H-%M')}.{fmt}"
+    report_file = tempfile.SpooledTemporaryFile(max_size=REPORT_SPILL_BYTES, suffix=f".{fmt}")
+
+    if fmt == "xlsx":
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(columns)
+        for row in rows:
+            sheet.append(row)
+        workbook.save(report_file)
+    else:
+        raw = gzip.GzipFile(fileobj=report_file, mode="wb") if fmt == "csv.gz" else report_file
+        text = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+        writer = csv.writer(text)
+        writer.writerow(columns)
+        writer.writerows(rows)
+        text.flush()
+        text.detach()
+        if raw is not report_file:
+            raw.close()
+
+    report_file.seek(0)
+    return filename, report_file
+
+
+@metrics.timed('report_build_seconds')
+def create_likers_report(fmt, post_info, likers_data):
+    if fmt == "docx" or fmt not in REPORT_FORMATS.values():
+        return create_likers_docx(post_info, likers_data)
+    rows = ((i, user["id"], user["name"], user["link"]) for i, user in enumerate(likers_data, 1))
+    return create_table_report(fmt, LIKERS_COLUMNS, rows, "Лайкнувшие")
+
+
+@metrics.timed('report_build_seconds')
+def create_activity_report(fmt, user_info, posts_data):
+    if fmt == "docx" or fmt not in REPORT_FORMATS.values():
+        return create_activity_docx(user_info, posts_data)
+    rows = (
+        (i, item["date"], item["link"], activity_mark(item, "liked"), activity_mark(item, "reposted"))
+        for i, item in enumerate(posts_data, 1)
+    )
+    return create_table_report(fmt, ACTIVITY_COLUMNS, rows, "Активность")
 
 
 def create_txt_report(groups_data, filename="vk_analysis_report.txt"):
@@ -158,22 +1146,714 @@ def create_txt_report(groups_data, filename="vk_analysis_report.txt"):
     return filename
 
 
+# === Пакетные вызовы VK через execute ===
+VK_EXECUTE_LIMIT = 25  # максимум обращений к API внутри одного execute
+
+
+def vk_execute_batch(calls):
+    """
+    Выполняет вызовы [(method, params), ...] пачками по 25 через execute.
+    Возвращает список результатов в том же порядке; на месте вызова,
+    завершившегося ошибкой, стоит None.
+    """
+    results = []
+    for chunk in _execute_chunks(calls):
+        items = [None] * len(chunk)
+        todo = list(range(len(chunk)))
+        for attempt in range(VK_MAX_RETRIES + 1):
+            try:
+                response = vk_session.method('execute', {'code': _execute_code([chunk[i] for i in todo])}, raw=True)
+            except Exception as e:
+                log_error("Ошибка execute", e)
+                break
+            todo = _merge_execute_items(items, todo, response)
+            if not todo or attempt == VK_MAX_RETRIES:
+                break
+            time.sleep(vk_backoff(_execute_retry_error(response), attempt))
+        results += items
+    return results
+
+
+def _execute_chunks(calls):
+    return [calls[start:start + VK_EXECUTE_LIMIT] for start in range(0, len(calls), VK_EXECUTE_LIMIT)]
+
+
+def _execute_code(chunk):
+    return "return [" + ",".join(
+        f"API.{method}({json.dumps(params, ensure_ascii=False)})"
+        for method, params in chunk
+    ) + "];"
+
+
+def _execute_items(chunk, response):
+    items = response.get('response') or []
+    results = []
+    for i in range(len(chunk)):
+        item = items[i] if i < len(items) else None
+        # упавший внутри execute вызов VK возвращает false
+        results.append(None if item is False else item)
+    return results
+
+
+def _execute_retry_error(response):
+    """Ошибка частоты запросов внутри execute, из-за которой стоит повторить вызовы."""
+    for error in response.get('execute_errors') or []:
+        if error.get('error_code') in VK_RETRY_CODES:
+            return ApiError(vk_session, error.get('method'), None, True, error)
+    return None
+
+
+def _merge_execute_items(items, todo, response):
+    """
+    Раскладывает ответ execute по местам items.
+    Возвращает индексы вызовов, которые упали из-за лимитов и стоит повторить.
+    """
+    retry = _execute_retry_error(response) is not None
+    for error in response.get('execute_errors') or []:
+        metrics.inc('vk_errors_total', method=error.get('method', 'execute'), code=error.get('error_code'))
+    failed = []
+    for i, item in zip(todo, _execute_items(todo, response)):
+        items[i] = item
+        if item is None and retry:
+            failed.append(i)
+    return failed
+
+
+def run_vk_plan(plan):
+    """
+    Выполняет план запросов: генератор выдаёт списки вызовов (method, params)
+    и получает обратно их результаты из vk_execute_batch.
+    """
+    try:
+        calls = next(plan)
+        while True:
+            calls = plan.send(vk_execute_batch(calls))
+    except StopIteration as stop:
+        return stop.value
+
+
+def _is_liked_calls(user_id, owner_id, post_ids):
+    return [
+        ('likes.isLiked', {'user_id': user_id, 'type': 'post', 'owner_id': owner_id, 'item_id': post_id})
+        for post_id in post_ids
+    ]
+
+
+# === Обратный движок активности: множества лайкнувших по постам ===
+LIKES_PAGE_SIZE = 1000      # максимум likes.getList за один вызов
+AUDIENCE_TTL = CACHE_TTL['likes']  # сколько секунд считаем список лайкнувших свежим
+
+# group_id -> времена последних проверок, чтобы оценить число пользователей
+GROUP_CHECKS_LIMIT = 1000  # групп, для которых помним недавние проверки
+group_checks = OrderedDict()  # group_id -> времена проверок за AUDIENCE_TTL, давно не проверявшиеся вытесняются
+group_checks_lock = threading.Lock()
+
+
+def _pages(count):
+    return math.ceil(count / LIKES_PAGE_SIZE) if count else 0
+
+
+def _sorted_ids(ids):
+    return array('q', sorted(set(ids)))
+
+
+def _contains(ids, user_id):
+    i = bisect.bisect_left(ids, user_id)
+    return i < len(ids) and ids[i] == user_id
+
+
+def _fresh_audience(owner_id, post, track=True):
+    """{'likes': array, 'copies': array} из кэша или локального индекса, либо None."""
+    audience = vk_cache.get('likes', (owner_id, post['id']), track)
+    if audience is VkCache.MISSING:
+        audience = like_index.get(owner_id, post)
+        if audience is None:
+            return None
+        vk_cache.set('likes', (owner_id, post['id']), audience)
+    return audience
+
+
+def _audience_plan(owner_id, posts, force=()):
+    """force — id постов, которые нужно перевыгрузить, даже если они есть в кэше."""
+    pending = {}  # (post_id, filter) -> собранные id
+    offsets = []  # (post_id, filter, offset) — страницы для следующего раунда
+    for post in posts:
+        if post['id'] not in force and _fresh_audience(owner_id, post, track=False):
+            continue
+        for kind, key in (('likes', 'likes'), ('copies', 'reposts')):
+            pending[(post['id'], kind)] = []
+            count = post.get(key, {}).get('count', 0)
+            offsets += [(post['id'], kind, page * LIKES_PAGE_SIZE) for page in range(_pages(count))]
+
+    failed = set()
+    while offsets:
+        calls = [
+            ('likes.getList', {'type': 'post', 'owner_id': owner_id, 'item_id': post_id,
+                               'filter': kind, 'offset': offset, 'count': LIKES_PAGE_SIZE})
+            for post_id, kind, offset in offsets
+        ]
+        next_offsets = []
+        for (post_id, kind, offset), page in zip(offsets, (yield calls)):
+            if not page:
+                failed.add(post_id)
+                continue
+            pending[(post_id, kind)].extend(page.get('items', []))
+            # счётчик в wall.get мог устареть — добираем недостающие страницы
+            last_offset = offset + LIKES_PAGE_SIZE
+            if last_offset < page.get('count', 0) and len(page.get('items', [])) == LIKES_PAGE_SIZE:
+                if not any(o[:2] == (post_id, kind) and o[2] >= last_offset for o in offsets):
+                    next_offsets.append((post_id, kind, last_offset))
+        offsets = [o for o in next_offsets if o[0] not in failed]
+
+    for post in posts:
+        post_id = post['id']
+        if (post_id, 'likes') not in pending or post_id in failed:
+            continue
+        audience = {
+            'likes': _sorted_ids(pending[(post_id, 'likes')]),
+            'copies': _sorted_ids(pending[(post_id, 'copies')]),
+        }
+        vk_cache.set('likes', (owner_id, post_id), audience)
+        like_index.put(owner_id, post, audience)
+
+
+def _expected_users(group_id):
+    """Сколько пользователей, судя по недавним запросам, проверят в этой группе."""
+    now = time.time()
+    with group_checks_lock:
+        recent = [t for t in group_checks.get(group_id, []) if now - t < AUDIENCE_TTL]
+        recent.append(now)
+        group_checks[group_id] = recent
+        group_checks.move_to_end(group_id)
+        while len(group_checks) > GROUP_CHECKS_LIMIT:
+            group_checks.popitem(last=False)
+    return len(recent)
+
+
+def choose_activity_strategy(owner_id, posts, users_count=1):
+    """
+    Сравнивает ожидаемое число запросов к VK:
+    'per_user' — likes.isLiked для каждого пользователя и поста,
+    'per_post' — один раз выгрузить лайкнувших по каждому посту.
+    """
+    per_user = users_count * math.ceil(len(posts) / VK_EXECUTE_LIMIT)
+    pages = sum(
+        _pages(post.get('likes', {}).get('count', 0)) + _pages(post.get('reposts', {}).get('count', 0))
+        for post in posts
+        if not _fresh_audience(owner_id, post, track=False)
+    )
+    per_post = math.ceil(pages / VK_EXECUTE_LIMIT)
+    return 'per_post' if per_post <= per_user else 'per_user'
+
+
+def _activity_plan(user_id, owner_id, posts, users_count=None):
+    if users_count is None:
+        users_count = _expected_users(owner_id)
+
+    if choose_activity_strategy(owner_id, posts, users_count) == 'per_post':
+        yield from _audience_plan(owner_id, posts)
+
+    results = [None] * len(posts)
+    missing = []
+    for i, post in enumerate(posts):
+        audience = _fresh_audience(owner_id, post)
+        if audience:
+            results[i] = {
+                'liked': int(_contains(audience['likes'], user_id)),
+                'copied': int(_contains(audience['copies'], user_id)),
+            }
+        else:
+            missing.append(i)
+
+    if missing:
+        infos = yield _is_liked_calls(user_id, owner_id, [posts[i]['id'] for i in missing])
+        for i, info in zip(missing, infos):
+            results[i] = info
+    return results
+
+
+# === Глубина анализа: постраничный обход стены ===
+WALL_PAGE_SIZE = 100  # максимум wall.get за один вызов
+WALL_PAGES_PER_BATCH = 10  # страниц стены в одном раунде запросов
+
+
+def parse_depth(text):
+    """
+    '500' — последние 500 постов, '01.01.2024' — посты с даты,
+    '01.01.2024-31.03.2024' — диапазон дат. None, если не удалось разобрать.
+    """
+    text = text.strip()
+    if text.isdigit():
+        return {'count': max(1, min(int(text), ANALYSIS_MAX_POSTS))}
+
+    dates = re.findall(r'\d{1,2}\.\d{1,2}\.\d{4}', text)
+    if not 1 <= len(dates) <= 2:
+        return None
+    try:
+        bounds = [datetime.datetime.strptime(date, '%d.%m.%Y') for date in dates]
+    except ValueError:
+        return None
+    depth = {'since': bounds[0].timestamp()}
+    if len(bounds) == 2:
+        if bounds[1] < bounds[0]:
+            return None
+        depth['until'] = (bounds[1] + datetime.timedelta(days=1)).timestamp() - 1
+    return depth
+
+
+def describe_depth(depth):
+    if 'count' in depth:
+        return f"{depth['count']} последних постов"
+    since = datetime.datetime.fromtimestamp(depth['since']).strftime('%d.%m.%Y')
+    if 'until' in depth:
+        until = datetime.datetime.fromtimestamp(depth['until']).strftime('%d.%m.%Y')
+        return f"посты с {since} по {until}"
+    return f"посты с {since}"
+
+
+def _depth_key(depth):
+    return depth['count'] if 'count' in depth else (depth['since'], depth.get('until'))
+
+
+def _advance(plan, results=None):
+    """Шаг вложенного плана: (вызовы, None) или (None, результат плана)."""
+    try:
+        return (next(plan) if results is None else plan.send(results)), None
+    except StopIteration as stop:
+        return None, stop.value
+
+
+def _deep_activity_plan(user_id, owner_id, depth, users_count=None, progress=None):
+    """
+    Обходит стену страницами wall.get (по WALL_PAGES_PER_BATCH за раунд) и
+    проверяет активность по уже полученным постам, не дожидаясь конца обхода:
+    проверки очередной порции уходят в том же execute, что и следующие
+    страницы стены. Обход останавливается, как только пройдена граница дат.
+    progress (ProgressMessage) получает счётчики после каждого раунда и
+    итоги готовых порций, пока проверка ещё продолжается.
+    Возвращает (posts, like_infos).
+    """
+    if users_count is None:
+        users_count = _expected_users(owner_id)
+
+    posts = vk_cache.get('wall', (owner_id, _depth_key(depth)))
+    if posts is not VkCache.MISSING:
+        infos = yield from _activity_plan(user_id, owner_id, posts, users_count)
+        return posts, infos
+
+    limit = min(depth.get('count', ANALYSIS_MAX_POSTS), ANALYSIS_MAX_POSTS)
+    pages = math.ceil(limit / WALL_PAGE_SIZE)
+    posts, infos, seen = [], [], set()
+    checks = []  # [(план проверки порции, его вызовы, индекс первого поста порции)]
+    next_page, done = 0, False
+    checked = 0
+
+    while not done or checks:
+        wall_pages = [] if done else list(range(next_page, min(pages, next_page + WALL_PAGES_PER_BATCH)))
+        next_page += len(wall_pages)
+        calls = [
+            ('wall.get', {'owner_id': owner_id, 'offset': page * WALL_PAGE_SIZE, 'count': WALL_PAGE_SIZE})
+            for page in wall_pages
+        ]
+        for _, pending, _ in checks:
+            calls += pending
+        results = yield calls
+
+        walls, results = results[:len(wall_pages)], results[len(wall_pages):]
+        running, finished = [], []
+        for plan, pending, start in checks:
+            part, results = results[:len(pending)], results[len(pending):]
+            pending, value = _advance(plan, part)
+            if pending is None:
+                infos[start:start + len(value)] = value
+                finished.append((start, len(value)))
+            else:
+                running.append((plan, pending, start))
+        checks = running
+
+        chunk = []
+        for wall in walls:
+            if wall is None:
+                if not posts and not chunk:
+                    raise RuntimeError("wall.get не вернул посты")
+                done = True
+                break
+            items = wall.get('items', [])
+            for post in items:
+                if 'since' in depth and post['date'] < depth['since']:
+                    # закреплённый пост может быть старше границы — листаем дальше
+                    done = done or not post.get('is_pinned')
+                    continue
+                if post['date'] > depth.get('until', post['date']) or post['id'] in seen:
+                    continue
+                seen.add(post['id'])
+                chunk.append(post)
+                if len(posts) + len(chunk) >= limit:
+                    done = True
+                    break
+            if done or len(items) < WALL_PAGE_SIZE:
+                done = True
+                break
+        if next_page >= pages:
+            done = True
+
+        if chunk:
+            start = len(posts)
+            posts += chunk
+            infos += [None] * len(chunk)
+            plan = _activity_plan(user_id, owner_id, chunk, users_count)
+            pending, value = _advance(plan)
+            if pending is None:
+                infos[start:start + len(value)] = value
+                finished.append((start, len(value)))
+            else:
+                checks.append((plan, pending, start))
+
+        checked += sum(count for _, count in finished)
+        if progress:
+            progress.update(checked, limit if 'count' in depth else None,
+                            f"Страниц стены: {next_page}, найдено постов: {len(posts)}")
+            # последняя порция войдёт в итоговый отчёт
+            if not done or checks:
+                for start, count in finished:
+                    progress.deliver(build_chunk_report(owner_id, start, posts[start:start + count],
+                                                        infos[start:start + count]))
+
+    vk_cache.set('wall', (owner_id, _depth_key(depth)), posts)
+    return posts, infos
+
+
+# === Постраничная выгрузка лайкнувших ===
+PROGRESS_INTERVAL = 3  # не чаще раза в столько секунд обновляем сообщение о прогрессе
+LIKERS_PAGE_SIZE = 100  # с extended=1 likes.getList отдаёт не больше 100 пользователей
+LIKERS_PAGES_PER_BATCH = VK_EXECUTE_LIMIT  # страниц likes.getList в одном execute
+
+
+def _likers_page_params(owner_id, post_id, offset):
+    return {
+        'type': 'post',
+        'owner_id': owner_id,
+        'item_id': post_id,
+        'offset': offset,
+        'count': LIKERS_PAGE_SIZE,
+        'extended': 1,
+        'fields': 'id,first_name,last_name',
+    }
+
+
+def _likers_offset_batches(total):
+    """
+    Смещения оставшихся страниц, сгруппированные по LIKERS_PAGES_PER_BATCH.
+    Шаг — запрошенный размер страницы: VK может вернуть страницу короче, и
+    шаг по её длине дал бы пересекающиеся страницы.
+    """
+    offsets = list(range(LIKERS_PAGE_SIZE, total, LIKERS_PAGE_SIZE))
+    return [offsets[i:i + LIKERS_PAGES_PER_BATCH] for i in range(0, len(offsets), LIKERS_PAGES_PER_BATCH)]
+
+
+def iter_post_likers(owner_id, post_id):
+    """
+    Генератор страниц likes.getList: выдаёт (всего лайков, [пользователи])
+    по одной странице, не держа весь список в памяти. Первая страница
+    запрашивается напрямую, остальные — пачками через execute.
+    """
+    page = vk.likes.getList(**_likers_page_params(owner_id, post_id, 0))
+    total = page.get('count', 0)
+    items = page.get('items', [])
+    if not items:
+        return
+    yield total, items
+
+    for offsets in _likers_offset_batches(total):
+        calls = [('likes.getList', _likers_page_params(owner_id, post_id, offset)) for offset in offsets]
+        for offset, page in zip(offsets, vk_execute_batch(calls)):
+            if page is None:
+                # повторяем напрямую, чтобы ошибка VK не потерялась
+                page = vk.likes.getList(**_likers_page_params(owner_id, post_id, offset))
+            if page.get('items'):
+                yield total, page['items']
+
+
+def liker_row(user):
+    return {
+        "id": user['id'],
+        "name": f"{user['first_name']} {user['last_name']}",
+        "link": f"https://vk.com/id{user['id']}",
+    }
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes} мин {seconds} сек" if minutes else f"{seconds} сек"
+
+
+class ProgressMessage:
+    """
+    Статус длинной операции в одном сообщении. Появляется, только если
+    операция идёт дольше PROGRESS_INTERVAL, и дальше редактируется на месте
+    не чаще раза в PROGRESS_INTERVAL секунд (Telegram ограничивает частоту правок).
+    """
+
+    def __init__(self, chat_id, title):
+        self.chat_id = chat_id
+        self.title = title
+        self.started = self.last_update = time.time()
+        self.message_id = None
+        self.text = None  # показанный текст; None — сообщения ещё нет
+        self.done = 0
+        self.total = None
+        self.details = ""
+
+    def update(self, done, total=None, details=""):
+        self.done, self.total, self.details = done, total, details
+        if time.time() - self.last_update >= PROGRESS_INTERVAL:
+            self._show(self.render())
+
+    def render(self):
+        text = f"⏳ {self.title}: {self.done}"
+        if self.total:
+            text += f" из {self.total}"
+        if self.details:
+            text += f"\n{self.details}"
+        if self.total and 0 < self.done < self.total:
+            eta = (time.time() - self.started) / self.done * (self.total - self.done)
+            text += f"\nОсталось примерно {format_duration(eta)}"
+        return text
+
+    def finish(self, text):
+        """Итог вместо прогресса — если прогресс успели показать."""
+        if self.text is not None:
+            self._show(text)
+
+    def deliver(self, text):
+        """Готовая часть результата отдельным сообщением."""
+        send_long_message(self.chat_id, text, disable_web_page_preview=True)
+
+    def _show(self, text):
+        self.last_update = time.time()
+        if text == self.text:
+            return
+        self.text = text
+        try:
+            if self.message_id is None:
+                self.message_id = bot.send_message(self.chat_id, text).message_id
+            else:
+                bot.edit_message_text(text, self.chat_id, self.message_id)
+        except Exception as e:
+            log_error("Ошибка обновления прогресса", e)
+
+
+def stream_liker_rows(chat_id, first_items, pages, total):
+    """
+    Отдаёт строки отчёта по мере прихода страниц и показывает
+    пользователю, сколько лайкнувших уже загружено.
+    """
+    yield from map(liker_row, first_items)
+    if len(first_items) >= total:
+        return
+
+    loaded, fetched = len(first_items), 1
+    page_count = math.ceil(total / LIKERS_PAGE_SIZE)
+    progress = ProgressMessage(chat_id, "Загружено лайкнувших")
+    for _, items in pages:
+        yield from map(liker_row, items)
+        loaded += len(items)
+        fetched += 1
+        progress.update(loaded, total, f"Страниц: {fetched} из {page_count}")
+    progress.finish(f"✅ Загружено {loaded} из {total}")
+
+
+# === Объединение одинаковых запросов (single-flight) ===
+class SingleFlight:
+    """
+    Одинаковые по ключу запросы, пришедшие, пока первый ещё выполняется,
+    не идут в VK заново, а ждут и получают его результат (или его ошибку).
+    """
+
+    def __init__(self):
+        self.flights = {}  # key -> [threading.Event, результат, ошибка]
+        self.lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key, fetch):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = [threading.Event(), None, None]
+            else:
+                self.shared += 1
+
+        if leader:
+            try:
+                flight[1] = fetch()
+            except Exception as e:
+                flight[2] = e
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight[0].set()
+        else:
+            flight[0].wait()
+
+        if flight[2] is not None:
+            raise flight[2]
+        return flight[1]
+
+
+class PageBroadcast:
+    """
+    Постраничная выгрузка, которую читают сразу несколько чатов.
+    Очередную страницу из VK забирает тот читатель, кому она понадобилась
+    первым; остальные берут её из буфера. Страница хранится, только пока
+    её не прочитали все подключённые читатели, так что у одиночного
+    читателя буфер не растёт. Когда первые страницы уже выброшены,
+    новый читатель подключиться не может и начинает свою выгрузку.
+    """
+    MISSING = object()
+
+    def __init__(self, source):
+        self.source = source
+        self.pages = deque()
+        self.dropped = 0  # сколько первых страниц прочитали все и они удалены
+        self.positions = {}  # читатель -> номер его следующей страницы
+        self.finished = False
+        self.error = None
+        self.lock = threading.Lock()  # учёт страниц и читателей
+        self.fetch_lock = threading.Lock()  # из источника читает один поток за раз
+
+    @property
+    def readers(self):
+        return len(self.positions)
+
+    def attach(self):
+        """Новый читатель с первой страницы; None — если она уже выброшена."""
+        with self.lock:
+            if self.dropped:
+                return None
+            reader = object()
+            self.positions[reader] = 0
+            return reader
+
+    def detach(self, reader):
+        with self.lock:
+            self.positions.pop(reader, None)
+            self._trim()
+
+    def _trim(self):
+        low = min(self.positions.values(), default=self.dropped + len(self.pages))
+        while self.dropped < low:
+            self.pages.popleft()
+            self.dropped += 1
+
+    def _take(self, reader):
+        """Следующая страница читателя; None — страниц больше нет, MISSING — её ещё не загрузили."""
+        with self.lock:
+            i = self.positions[reader] - self.dropped
+            if i < len(self.pages):
+                self.positions[reader] += 1
+                page = self.pages[i]
+                self._trim()
+                return page
+            if self.error is not None:
+                raise self.error
+            return None if self.finished else self.MISSING
+
+    def _loaded(self, reader):
+        with self.lock:
+            return self.finished or self.positions[reader] - self.dropped < len(self.pages)
+
+    def _append(self, page):
+        with self.lock:
+            self.pages.append(page)
+
+    def _finish(self, error=None):
+        with self.lock:
+            self.finished = True
+            self.error = error
+
+    def read(self, reader):
+        try:
+            while True:
+                page = self._take(reader)
+                if page is None:
+                    return
+                if page is self.MISSING:
+                    with self.fetch_lock:
+                        if not self._loaded(reader):
+                            try:
+                                self._append(next(self.source))
+                            except StopIteration:
+                                self._finish()
+                            except Exception as e:
+                                self._finish(e)
+                    continue
+                yield page
+        finally:
+            self.detach(reader)
+
+
+vk_flights = SingleFlight()
+likers_flights = {}  # (owner_id, post_id) -> PageBroadcast
+likers_flights_lock = threading.Lock()
+
+
+def shared_post_likers(owner_id, post_id):
+    """
+    То же, что iter_post_likers, но одновременные запросы одного поста
+    используют одну выгрузку из VK.
+    """
+    key = (owner_id, post_id)
+    with likers_flights_lock:
+        flight = likers_flights.get(key)
+        reader = flight.attach() if flight is not None else None
+        if reader is None:
+            flight = likers_flights[key] = PageBroadcast(iter_post_likers(owner_id, post_id))
+            reader = flight.attach()
+        else:
+            vk_flights.shared += 1
+    try:
+        yield from flight.read(reader)
+    finally:
+        with likers_flights_lock:
+            if (flight.finished or not flight.readers) and likers_flights.get(key) is flight:
+                del likers_flights[key]
+
+
 # === Вспомогательные функции ===
 def resolve_vk_id(screen_name):
     try:
-        resolved = vk.utils.resolveScreenName(screen_name=screen_name.strip())
-        if resolved and resolved.get('object_id'):
-            return -resolved['object_id'] if resolved['type'] == 'group' else resolved['object_id']
-        return None
-    except:
+        screen_name = screen_name.strip()
+        resolved = cached('screen_name', screen_name.lower(),
+                          lambda: vk.utils.resolveScreenName(screen_name=screen_name))
+        return vk_id_from_resolved(resolved)
+    except Exception as e:
+        log_error("Ошибка определения id ВК", e)
         return None
 
 
+def vk_id_from_resolved(resolved):
+    """id из ответа utils.resolveScreenName: у групп — отрицательный."""
+    if resolved and resolved.get('object_id'):
+        return -resolved['object_id'] if resolved['type'] == 'group' else resolved['object_id']
+    return None
+
+
 def extract_screen_name(url):
     match = re.search(r'vk\.com/([a-zA-Z0-9._-]+)', url or "")
     return match.group(1) if match else None
 
 
+def extract_screen_names(text):
+    """Короткие имена из списка ссылок (или просто id123 / screen_name) без повторов."""
+    names = []
+    for token in re.split(r'[\s,;]+', text or ""):
+        name = extract_screen_name(token) or (token if re.fullmatch(r'[a-zA-Z0-9._]+', token) else None)
+        if name and name.lower() not in names:
+            names.append(name.lower())
+    return names
+
+
 def parse_post_link(link):
     patterns = [
         r'vk\.com/wall(-?\d+)_(\d+)',
@@ -191,223 +1871,934 @@ def parse_post_link(link):
 
 
 # === ФУНКЦИЯ ОТПРАВКИ ОТЧЕТА ВЛАДЕЛЬЦУ ===
-def send_report_to_owner(chat_id, username, message_text, report_type):
-    try:
-        if YOUR_CHAT_ID:
-            clean_text = re.sub('<[^<]+?>', '', message_text)
-            clean_text = clean_text.replace('&nbsp;', ' ').replace('&amp;', '&')
-            
-            report = f"""📊 ОТЧЕТ ОТ БОТА
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def format_owner_report(chat_id, username, message_text, report_type, when=None):
+    when = when or datetime.datetime.now()
+    clean_text = re.sub('<[^<]+?>', '', message_text)
+    clean_text = clean_text.replace('&nbsp;', ' ').replace('&amp;', '&')
+
+    return f"""📊 ОТЧЕТ ОТ БОТА
 ━━━━━━━━━━━━━━━━━━━━
 👤 Пользователь: @{username if username else 'не указан'}
 🆔 Chat ID: {chat_id}
 📊 Тип отчета: {report_type}
-🕒 Время: {datetime.datetime.now().strftime('%d.%m.%Y %H:%M')}
+🕒 Время: {when.strftime('%d.%m.%Y %H:%M')}
 ━━━━━━━━━━━━━━━━━━━━
 
 {clean_text}
 ━━━━━━━━━━━━━━━━━━━━
 ✅ Отчет сгенерирован автоматически"""
-            
-            bot.send_message(YOUR_CHAT_ID, report)
-    except Exception as e:
-        print(f"Ошибка при отправке отчета владельцу: {e}")
 
 
-# === Клавиатуры ===
-def main_menu_keyboard():
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    markup.add("Начать анализ", "Кто лайкнул пост")
-    markup.add("Помощь")
-    return markup
+def split_text(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Режет текст на куски не длиннее limit, по возможности по границам строк."""
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            candidate = line
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+_HTML_TAG = re.compile(r'<(/?)(\w+)[^>]*>')
+_HTML_ATOM = re.compile(r'<[^>]*>|&#?\w+;|[^<&]{1,256}|[<&]')
+
+
+def _update_tags(tags, piece):
+    """Открытые теги [(имя, открывающий тег)] после куска piece."""
+    tags = list(tags)
+    for match in _HTML_TAG.finditer(piece):
+        name = match.group(2).lower()
+        if not match.group(1):
+            tags.append((name, match.group(0)))
+            continue
+        for i in range(len(tags) - 1, -1, -1):
+            if tags[i][0] == name:
+                del tags[i]
+                break
+    return tags
+
+
+def _closing_tags(tags):
+    return "".join(f"</{name}>" for name, _ in reversed(tags))
+
+
+def _html_pieces(line, size):
+    """Части строки не длиннее size, не разрезающие теги и &-сущности."""
+    if len(line) <= size:
+        return [line]
+    pieces, current = [], ""
+    for atom in _HTML_ATOM.findall(line):
+        if current and len(current) + len(atom) > size:
+            pieces.append(current)
+            current = ""
+        current += atom
+    return pieces + [current]
+
+
+def split_html(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Режет текст с HTML-разметкой Telegram на сообщения не длиннее limit,
+    по возможности по границам строк. Теги, открытые на месте разреза,
+    закрываются в конце сообщения и открываются заново в следующем.
+    """
+    chunks = []
+    tags = []
+    current = ""
+    for i, line in enumerate(text.split("\n")):
+        for j, piece in enumerate(_html_pieces(line, limit // 2)):
+            sep = "\n" if i and not j else ""
+            after = _update_tags(tags, piece)
+            if current and len(current) + len(sep) + len(piece) + len(_closing_tags(after)) > limit:
+                chunks.append(current + _closing_tags(tags))
+                current = "".join(tag for _, tag in tags)
+                sep = ""
+            current += sep + piece
+            tags = after
+    if _HTML_TAG.sub("", current).strip():
+        chunks.append(current + _closing_tags(tags))
+    return chunks
+
+
+def send_long_message(chat_id, text, reply_markup=None, **kwargs):
+    """Отправляет HTML-текст одним или несколькими сообщениями; клавиатура — у последнего."""
+    chunks = split_html(text)
+    for i, chunk in enumerate(chunks):
+        bot.send_message(chat_id, chunk, parse_mode="HTML",
+                         reply_markup=reply_markup if i == len(chunks) - 1 else None, **kwargs)
+
+
+class OwnerReporter:
+    """
+    Фоновая отправка отчётов владельцу: события копятся в очереди и раз в
+    OWNER_REPORT_INTERVAL секунд уходят одной сводкой (с разбиением по 4096
+    символов). При переполнении очереди события отбрасываются или
+    дописываются в файл (OWNER_REPORT_OVERFLOW=spill) и отправляются позже.
+    """
 
+    def __init__(self, interval, max_queue, overflow, spill_path):
+        self.interval = interval
+        self.events = queue.Queue(max_queue)
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def push(self, chat_id, username, message_text, report_type):
+        event = (chat_id, username, message_text, report_type, time.time())
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="owner-reporter", daemon=True)
+                    self.thread.start()
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            if self.overflow == 'spill':
+                self._spill(event)
+            else:
+                with self.lock:
+                    self.dropped += 1
 
-def cancel_keyboard():
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add("Отмена")
-    return markup
+    def _spill(self, event):
+        with self.lock:
+            try:
+                with open(self.spill_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            except OSError as e:
+                log_error("Ошибка записи отчёта на диск", e)
+                self.dropped += 1
+
+    def _take_spilled(self):
+        with self.lock:
+            try:
+                with open(self.spill_path, encoding='utf-8') as f:
+                    events = [json.loads(line) for line in f if line.strip()]
+                os.remove(self.spill_path)
+            except FileNotFoundError:
+                events = []
+            except (OSError, ValueError) as e:
+                log_error("Ошибка чтения отчётов с диска", e)
+                events = []
+            dropped, self.dropped = self.dropped, 0
+        return events, dropped
+
+    def flush(self):
+        events, dropped = self._take_spilled()
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        if not events and not dropped:
+            return
 
+        parts = [
+            format_owner_report(chat_id, username, text, report_type, datetime.datetime.fromtimestamp(ts))
+            for chat_id, username, text, report_type, ts in sorted(events, key=lambda e: e[4])
+        ]
+        if dropped:
+            parts.append(f"⚠️ Очередь отчётов переполнена, пропущено событий: {dropped}")
+        digest = f"🗂 Сводка: {len(events)} событий\n\n" + "\n\n".join(parts)
 
-# === КОМАНДА /start ===
-@bot.message_handler(commands=['start'])
-def start_command(message):
-    response = (
-        "<b>Привет!</b>\n\n"
-        "Я умею:\n"
-        "• Проверять, лайкал ли человек посты в группе\n"
-        "• Показывать, кто лайкнул любой пост ВК\n\n"
-        "Результаты присылаются:\n"
-        "• Подробным сообщением\n"
-        "• Файлом DOCX\n\n"
-        "Выбери функцию:"
-    )
-    
-    bot.send_message(
-        message.chat.id,
-        response,
-        parse_mode="HTML",
-        reply_markup=main_menu_keyboard()
-    )
-    
-    username = message.from_user.username if message.from_user.username else "не указан"
-    send_report_to_owner(message.chat.id, username, response, "Команда /start")
+        for chunk in split_text(digest):
+            try:
+                bot.send_message(YOUR_CHAT_ID, chunk)
+            except Exception as e:
+                log_error("Ошибка при отправке отчета владельцу", e)
 
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                log_error("Ошибка при отправке отчета владельцу", e)
 
-# === ОСНОВНОЙ ОБРАБОТЧИК ТЕКСТА ===
-@bot.message_handler(content_types=['text'])
-def handle_text(message):
-    chat_id = message.chat.id
-    text = message.text.strip()
+
+owner_reporter = OwnerReporter(OWNER_REPORT_INTERVAL, OWNER_REPORT_QUEUE, OWNER_REPORT_OVERFLOW, OWNER_REPORT_SPILL)
+atexit.register(owner_reporter.flush)
+
+
+def send_report_to_owner(chat_id, username, message_text, report_type):
+    """Ставит отчёт в очередь сводки владельцу, не задерживая ответ пользователю."""
+    if YOUR_CHAT_ID:
+        owner_reporter.push(chat_id, username, message_text, report_type)
+
+
+# === Очередь задач ===
+class JobQueue:
+    """
+    Пул потоков для долгих задач VK с общей очередью.
+    Задачи одного чата выполняются строго по очереди: пока у чата есть
+    активная задача, его новые сообщения ждут своей очереди за ней.
+    """
+
+    def __init__(self, workers, limit):
+        self.workers = workers
+        self.limit = limit
+        self.pending = deque()  # (chat_id, func, args, долгая ли задача)
+        self.busy_chats = set()
+        self.running = 0
+        self.started = False
+        self.cond = threading.Condition()
+
+    def _start(self):
+        self.started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True).start()
+
+    def _has_work(self, chat_id):
+        return chat_id in self.busy_chats or any(job[0] == chat_id for job in self.pending)
+
+    def submit(self, chat_id, func, *args):
+        """
+        Ставит долгую задачу в очередь. Возвращает позицию в очереди
+        (0 — задача будет взята сразу) или None, если очередь переполнена.
+        """
+        with self.cond:
+            if not self.started:
+                self._start()
+            queued = sum(1 for job in self.pending if job[3])
+            if queued >= self.limit:
+                return None
+            self.pending.append((chat_id, func, args, True))
+            self.cond.notify()
+            return max(0, self.running + queued + 1 - self.workers)
+
+    def dispatch(self, chat_id, func, *args):
+        """
+        Обрабатывает сообщение сразу в текущем потоке, если у чата нет
+        активных задач, иначе ставит его в очередь за ними.
+        """
+        with self.cond:
+            if self._has_work(chat_id):
+                if not self.started:
+                    self._start()
+                self.pending.append((chat_id, func, args, False))
+                self.cond.notify()
+                return
+            self.busy_chats.add(chat_id)
+        self._run(chat_id, func, args)
+
+    def _run(self, chat_id, func, args):
+        try:
+            with slow_profiler.watch(func.__name__):
+                func(*args)
+        except Exception as e:
+            log_error("Ошибка задачи", e)
+        finally:
+            with self.cond:
+                self.busy_chats.discard(chat_id)
+                self.cond.notify_all()
+
+    def _next_job(self):
+        for job in self.pending:
+            if job[0] not in self.busy_chats:
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                job = self._next_job()
+                while job is None:
+                    self.cond.wait()
+                    job = self._next_job()
+                self.pending.remove(job)
+                self.busy_chats.add(job[0])
+                self.running += 1
+            self._run(job[0], job[1], job[2])
+            with self.cond:
+                self.running -= 1
+
+
+jobs = JobQueue(JOB_WORKERS, JOB_QUEUE_LIMIT)
+
+
+MENU_BUTTONS = {"Начать анализ", "Кто лайкнул пост", "Массовая проверка", "Рейтинг группы",
+                "Формат отчёта", "Глубина анализа", "Помощь", "Отмена"}
+
+
+def handler_branch(message):
+    """Метка ветки обработчика для метрик: команда, кнопка меню или шаг диалога."""
+    text = (getattr(message, 'text', None) or "").strip()
+    if text.startswith('/'):
+        command = text.split()[0].split('@')[0]
+        return command if command in ('/start', '/stats') else 'command'
+    if text in MENU_BUTTONS:
+        return text
+    step = user_states.get(message.chat.id, {}).get('step')
+    if step:
+        return step
+    return 'document' if getattr(message, 'document', None) else 'other'
+
+
+def chat_serialized(handler):
+    """Пропускает сообщения одного чата через очередь задач по одному."""
+    @functools.wraps(handler)
+    def run(message):
+        # ветку определяем при запуске: к этому времени шаг диалога уже обновлён предыдущими сообщениями
+        with metrics.timer('handler_seconds', branch=handler_branch(message)):
+            handler(message)
+
+    @functools.wraps(handler)
+    def wrapper(message):
+        jobs.dispatch(message.chat.id, run, message)
+    return wrapper
+
+
+def submit_long_job(chat_id, username, func, *args):
+    """
+    Отправляет долгую задачу в пул. Если очередь переполнена — сообщает
+    об этом пользователю и возвращает None.
+    """
+    position = jobs.submit(chat_id, func, *args)
+    if position is None:
+        response = "⚠️ Бот сейчас перегружен. Попробуй отправить ссылку ещё раз через пару минут."
+        bot.send_message(chat_id, response)
+        send_report_to_owner(chat_id, username, response, "Очередь переполнена")
+    return position
+
+
+def send_report_file(chat_id, report, caption):
+    filename, report_file = report
+    with report_file, metrics.timer('report_upload_seconds'):
+        bot.send_document(chat_id, report_file, caption=caption, visible_file_name=filename)
+
+
+# === СТАТИСТИКА: /stats и /metrics ===
+def collect_gauges():
+    """Текущие значения (очередь, кэш, индекс лайков) для /metrics."""
+    with jobs.cond:
+        gauges = [('jobs_running', {}, jobs.running), ('jobs_queued', {}, len(jobs.pending))]
+    cache = vk_cache.stats()
+    gauges.append(('vk_cache_items', {}, cache.pop('size')))
+    for kind, counts in cache.items():
+        gauges.append(('vk_cache_hits', {'kind': kind}, counts['hits']))
+        gauges.append(('vk_cache_misses', {'kind': kind}, counts['misses']))
+    gauges.append(('vk_shared_requests', {}, vk_flights.shared))
+    for token in vk_session.stats():
+        gauges.append(('vk_token_in_flight', {'token': token['token']}, token['in_flight']))
+        gauges.append(('vk_token_wait_seconds', {'token': token['token']}, token['total_wait']))
+    index = like_index.stats()
+    gauges.append(('like_index_posts', {}, index['posts']))
+    gauges.append(('like_index_bytes', {}, index['bytes']))
+    return gauges
+
+
+def build_stats_report():
+    uptime = format_duration(time.time() - metrics.started)
+    with jobs.cond:
+        running, queued = jobs.running, len(jobs.pending)
+    cache = vk_cache.stats()
+    lines = [
+        f"📊 Статистика за {uptime}",
+        f"Задачи: выполняется {running}, в очереди {queued}",
+        f"Кэш VK: {cache.pop('size')} записей",
+    ]
+    for kind, counts in cache.items():
+        lines.append(f"• {kind}: попаданий {counts['hits']}, промахов {counts['misses']}")
+    lines.append(f"Общих запросов (single-flight): {vk_flights.shared}")
+    lines.append("Токены VK:")
+    for token in vk_session.stats():
+        errors = ", ".join(f"{code}×{count}" for code, count in token['errors'].items()) or "нет"
+        lines.append(f"• {token['token']}: запросов {token['calls']}, ожидание ср. {token['avg_wait']} с, "
+                     f"макс. {token['max_wait']} с, ошибки: {errors}")
+    index = like_index.stats()
+    lines.append(f"Индекс лайков: {index['posts']} постов, {index['bytes'] // 1024} КБ, попаданий {index['hits']}")
+    summary = metrics.summary()
+    if summary:
+        lines.append("\n" + summary)
+    if slow_profiler.reports:
+        lines.append("\nМедленные задачи:")
+        lines.extend(slow_profiler.reports)
+    return "\n".join(lines)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Отдаёт метрики процесса в формате Prometheus на /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics.render(collect_gauges()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server():
+    """Поднимает /metrics в фоновом потоке, если задан METRICS_PORT."""
+    if not METRICS_PORT:
+        return None
+    server = http.server.ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+
+def is_owner(chat_id):
+    return str(chat_id) == str(YOUR_CHAT_ID)
+
+
+# === Клавиатуры ===
+def main_menu_keyboard():
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add("Начать анализ", "Кто лайкнул пост")
+    markup.add("Массовая проверка", "Рейтинг группы")
+    markup.add("Формат отчёта", "Глубина анализа")
+    markup.add("Помощь")
+    return markup
+
+
+def format_keyboard():
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add(*REPORT_FORMATS)
+    markup.add("Отмена")
+    return markup
+
+
+def cancel_keyboard():
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add("Отмена")
+    return markup
+
+
+# === Тексты ===
+START_TEXT = (
+    "<b>Привет!</b>\n\n"
+    "Я умею:\n"
+    "• Проверять, лайкал ли человек посты в группе\n"
+    "• Показывать, кто лайкнул любой пост ВК\n"
+    "• Проверять сразу список профилей\n"
+    "• Составлять рейтинг самых активных в группе\n\n"
+    "Результаты присылаются:\n"
+    "• Подробным сообщением\n"
+    "• Файлом DOCX, CSV или XLSX\n\n"
+    "Выбери функцию:"
+)
+
+HELP_TEXT = (
+    "Доступные команды:\n"
+    "• Начать анализ — проверка активности в группе\n"
+    "• Кто лайкнул пост — список лайкнувших\n"
+    "• Массовая проверка — активность списка профилей в группе\n"
+    "• Рейтинг группы — самые активные по последним постам\n"
+    "• Глубина анализа — сколько постов или за какие даты проверять\n"
+    "• Формат отчёта — DOCX, CSV, CSV (gzip) или XLSX\n\n"
+    "Результаты присылаются:\n"
+    "• Подробным сообщением\n"
+    "• Файлом выбранного формата"
+)
+
+BULK_GROUP_PROMPT = "<b>Отправь ссылку на группу ВК</b>\n\nЗатем пришлёшь список профилей для проверки"
+BULK_USERS_PROMPT = (
+    "<b>Группа принята!</b>\n\n"
+    f"Теперь отправь ссылки на профили (до {BULK_MAX_USERS}) — каждую с новой строки "
+    "или файлом .txt / .csv"
+)
+BULK_STARTED_TEXT = "Проверяю активность списка профилей...\nОтчёт придёт одним файлом"
+LEADERBOARD_STARTED_TEXT = f"Составляю рейтинг по {LEADERBOARD_POSTS} последним постам...\nПовторные запросы считаются быстрее"
+FORMAT_PROMPT = "Выбери формат файла с результатами.\nCSV и XLSX удобнее для больших списков."
+
+ANALYSIS_STARTED_TEXT = "Анализирую {}...\nОжидай 15–30 секунд, глубокий анализ займёт дольше"
+DEPTH_PROMPT = (
+    "Сколько постов проверять?\n"
+    f"• Число — последние N постов (до {ANALYSIS_MAX_POSTS})\n"
+    "• Дата — все посты начиная с неё, например 01.01.2024\n"
+    "• Диапазон — например 01.01.2024-31.03.2024"
+)
+POST_LINK_PROMPT = (
+    "Отправь ссылку на любой пост ВК\n"
+    "Пример: https://vk.com/wall-123456789_987654"
+)
+BAD_POST_LINK_TEXT = "Не могу распознать ссылку на пост.\nПопробуй скопировать ссылку прямо из приложения ВК."
+
+
+# === КОМАНДА /start ===
+@bot.message_handler(commands=['start'])
+@chat_serialized
+def start_command(message):
+    response = START_TEXT
+    
+    bot.send_message(
+        message.chat.id,
+        response,
+        parse_mode="HTML",
+        reply_markup=main_menu_keyboard()
+    )
+    
     username = message.from_user.username if message.from_user.username else "не указан"
+    send_report_to_owner(message.chat.id, username, response, "Команда /start")
+
+
+# === КОМАНДА /stats (только для владельца) ===
+@bot.message_handler(commands=['stats'])
+@chat_serialized
+def stats_command(message):
+    if not is_owner(message.chat.id):
+        return
+    for chunk in split_text(build_stats_report()):
+        bot.send_message(message.chat.id, chunk)
+
+
+# === ДИАЛОГ: общая логика синхронного и асинхронного режима ===
+def text_dialog(chat_id, username, text):
+    """
+    Решает, что ответить на сообщение и какой шаг диалога запомнить.
+    Как и планы запросов VK, сам ничего не отправляет, а отдаёт действия
+    исполнителю (run_dialog или async_run_dialog):
+      ('send', текст, параметры send_message) — ответ пользователю;
+      ('report', текст, тип отчёта)          — копия владельцу;
+      ('resolve', screen_name)               — получает id ВК или None;
+      ('download', file_id)                  — получает текст файла или None;
+      ('submit', задача, аргументы)          — получает позицию в очереди или None, если очередь полна.
+    """
+    step = user_states.get(chat_id, {}).get('step')
 
     if text == "Начать анализ":
         response = "<b>Отправь ссылку на группу ВК</b>"
-        bot.send_message(chat_id, response, parse_mode="HTML", reply_markup=cancel_keyboard())
+        yield 'send', response, {'parse_mode': "HTML", 'reply_markup': cancel_keyboard()}
         user_states[chat_id] = {'step': 'awaiting_group'}
-        send_report_to_owner(chat_id, username, response, "Начало анализа")
+        yield 'report', response, "Начало анализа"
 
     elif text == "Кто лайкнул пост":
-        response = (
-            "Отправь ссылку на любой пост ВК\n"
-            "Пример: https://vk.com/wall-123456789_987654"
-        )
-        bot.send_message(chat_id, response, reply_markup=cancel_keyboard())
+        response = POST_LINK_PROMPT
+        yield 'send', response, {'reply_markup': cancel_keyboard()}
         user_states[chat_id] = {'step': 'awaiting_post_link'}
-        send_report_to_owner(chat_id, username, response, "Запрос лайкнувших пост")
+        yield 'report', response, "Запрос лайкнувших пост"
+
+    elif text == "Массовая проверка":
+        response = BULK_GROUP_PROMPT
+        yield 'send', response, {'parse_mode': "HTML", 'reply_markup': cancel_keyboard()}
+        user_states[chat_id] = {'step': 'awaiting_bulk_group'}
+        yield 'report', response, "Начало массовой проверки"
+
+    elif text == "Рейтинг группы":
+        response = "<b>Отправь ссылку на группу ВК</b>"
+        yield 'send', response, {'parse_mode': "HTML", 'reply_markup': cancel_keyboard()}
+        user_states[chat_id] = {'step': 'awaiting_top_group'}
+        yield 'report', response, "Запрос рейтинга группы"
+
+    elif text == "Формат отчёта":
+        response = f"{FORMAT_PROMPT}\nСейчас: {format_title(report_formats.get(chat_id, REPORT_FORMAT))}"
+        yield 'send', response, {'reply_markup': format_keyboard()}
+        user_states[chat_id] = {'step': 'awaiting_format'}
+        yield 'report', response, "Выбор формата"
+
+    elif text == "Глубина анализа":
+        response = f"{DEPTH_PROMPT}\n\nСейчас: {describe_depth(analysis_depths.get(chat_id, {'count': ANALYSIS_POSTS}))}"
+        yield 'send', response, {'reply_markup': cancel_keyboard()}
+        user_states[chat_id] = {'step': 'awaiting_depth'}
+        yield 'report', response, "Выбор глубины"
 
     elif text == "Помощь":
-        help_text = (
-            "Доступные команды:\n"
-            "• Начать анализ — проверка активности в группе\n"
-            "• Кто лайкнул пост — список лайкнувших\n\n"
-            "Результаты присылаются:\n"
-            "• Подробным сообщением\n"
-            "• Файлом DOCX"
-        )
-        bot.send_message(chat_id, help_text, reply_markup=main_menu_keyboard())
-        send_report_to_owner(chat_id, username, help_text, "Запрос помощи")
+        yield 'send', HELP_TEXT, {'reply_markup': main_menu_keyboard()}
+        yield 'report', HELP_TEXT, "Запрос помощи"
 
     elif text == "Отмена":
         user_states.pop(chat_id, None)
-        bot.send_message(chat_id, "Отменено!", reply_markup=main_menu_keyboard())
-        send_report_to_owner(chat_id, username, "Пользователь отменил операцию", "Отмена")
+        yield 'send', "Отменено!", {'reply_markup': main_menu_keyboard()}
+        yield 'report', "Пользователь отменил операцию", "Отмена"
 
-    elif user_states.get(chat_id, {}).get('step') == 'awaiting_group':
-        screen_name = extract_screen_name(text)
-        if not screen_name:
-            response = "Не понял ссылку на группу."
-            bot.send_message(chat_id, response)
-            send_report_to_owner(chat_id, username, response, "Ошибка группы")
+    elif step == 'awaiting_format':
+        if text not in REPORT_FORMATS:
+            yield 'send', "Выбери формат кнопкой ниже.", {'reply_markup': format_keyboard()}
             return
-        
-        group_id = resolve_vk_id(screen_name)
-        if not group_id or group_id > 0:
-            response = "Это не группа ВК."
-            bot.send_message(chat_id, response)
-            send_report_to_owner(chat_id, username, response, "Ошибка группы")
+        report_formats[chat_id] = REPORT_FORMATS[text]
+        user_states.pop(chat_id, None)
+        response = f"Формат отчёта: {text}"
+        yield 'send', response, {'reply_markup': main_menu_keyboard()}
+        yield 'report', response, "Формат выбран"
+
+    elif step == 'awaiting_depth':
+        depth = parse_depth(text)
+        if not depth:
+            yield 'send', "Не понял. Пришли число постов, дату или диапазон дат.", {}
             return
-        
-        user_states[chat_id] = {'step': 'awaiting_user', 'group_id': group_id}
-        response = "<b>Группа принята!</b>\n\nТеперь отправь ссылку на профиль человека"
-        bot.send_message(chat_id, response, parse_mode="HTML", reply_markup=cancel_keyboard())
-        send_report_to_owner(chat_id, username, response, "Группа принята")
+        analysis_depths[chat_id] = depth
+        user_states.pop(chat_id, None)
+        response = f"Глубина анализа: {describe_depth(depth)}"
+        yield 'send', response, {'reply_markup': main_menu_keyboard()}
+        yield 'report', response, "Глубина выбрана"
 
-    elif user_states.get(chat_id, {}).get('step') == 'awaiting_user':
+    elif step == 'awaiting_bulk_users':
+        yield from bulk_dialog(chat_id, username, text)
+
+    elif step in ('awaiting_group', 'awaiting_bulk_group', 'awaiting_top_group', 'awaiting_user'):
+        is_group = step != 'awaiting_user'
         screen_name = extract_screen_name(text)
         if not screen_name:
-            response = "Не понял ссылку на человека."
-            bot.send_message(chat_id, response)
-            send_report_to_owner(chat_id, username, response, "Ошибка пользователя")
+            response = f"Не понял ссылку на {'группу' if is_group else 'человека'}."
+            yield 'send', response, {}
+            yield 'report', response, "Ошибка группы" if is_group else "Ошибка пользователя"
             return
-        
-        user_id = resolve_vk_id(screen_name)
-        if not user_id or user_id < 0:
+
+        vk_id = yield 'resolve', screen_name
+        if is_group:
+            if not vk_id or vk_id > 0:
+                response = "Это не группа ВК."
+                yield 'send', response, {}
+                yield 'report', response, "Ошибка группы"
+                return
+            if step == 'awaiting_top_group':
+                position = yield 'submit', group_leaderboard, (chat_id, vk_id, username)
+                if position is None:
+                    return
+                user_states.pop(chat_id, None)
+                response = LEADERBOARD_STARTED_TEXT
+                yield 'send', response, {'reply_markup': types.ReplyKeyboardRemove()}
+                yield 'report', response, "Начало рейтинга группы"
+                yield from queue_notice(position)
+                return
+            if step == 'awaiting_bulk_group':
+                user_states[chat_id] = {'step': 'awaiting_bulk_users', 'group_id': vk_id}
+                response = BULK_USERS_PROMPT
+            else:
+                user_states[chat_id] = {'step': 'awaiting_user', 'group_id': vk_id}
+                response = "<b>Группа принята!</b>\n\nТеперь отправь ссылку на профиль человека"
+            yield 'send', response, {'parse_mode': "HTML", 'reply_markup': cancel_keyboard()}
+            yield 'report', response, "Группа принята"
+            return
+
+        if not vk_id or vk_id < 0:
             response = "Это не личный профиль."
-            bot.send_message(chat_id, response)
-            send_report_to_owner(chat_id, username, response, "Ошибка пользователя")
+            yield 'send', response, {}
+            yield 'report', response, "Ошибка пользователя"
             return
 
-        response = "Анализирую 30 последних постов...\nОжидай 15–30 секунд"
-        bot.send_message(chat_id, response, reply_markup=types.ReplyKeyboardRemove())
-        send_report_to_owner(chat_id, username, response, "Начало анализа активности")
-        analyze_user_activity(chat_id, user_states[chat_id]['group_id'], user_id, username)
+        group_id = user_states[chat_id]['group_id']
+        depth = analysis_depths.get(chat_id, {'count': ANALYSIS_POSTS})
+        position = yield 'submit', analyze_user_activity, (chat_id, group_id, vk_id, username, depth)
+        if position is None:
+            return
         user_states.pop(chat_id, None)
 
-    elif user_states.get(chat_id, {}).get('step') == 'awaiting_post_link':
-        if text == "Отмена":
-            user_states.pop(chat_id, None)
-            bot.send_message(chat_id, "Отменено!", reply_markup=main_menu_keyboard())
-            send_report_to_owner(chat_id, username, "Пользователь отменил операцию", "Отмена поста")
-            return
+        response = ANALYSIS_STARTED_TEXT.format(describe_depth(depth))
+        yield 'send', response, {'reply_markup': types.ReplyKeyboardRemove()}
+        yield 'report', response, "Начало анализа активности"
+        yield from queue_notice(position)
 
+    elif step == 'awaiting_post_link':
         owner_id, post_id = parse_post_link(text)
         if not owner_id or not post_id:
-            response = "Не могу распознать ссылку на пост.\nПопробуй скопировать ссылку прямо из приложения ВК."
-            bot.send_message(chat_id, response)
-            send_report_to_owner(chat_id, username, response, "Ошибка ссылки на пост")
+            response = BAD_POST_LINK_TEXT
+            yield 'send', response, {}
+            yield 'report', response, "Ошибка ссылки на пост"
             return
 
-        response = "Собираю лайки... (до 1000 человек)"
-        bot.send_message(chat_id, response, reply_markup=types.ReplyKeyboardRemove())
-        send_report_to_owner(chat_id, username, response, "Начало сбора лайков")
-        get_post_likers(chat_id, owner_id, post_id, username)
+        position = yield 'submit', get_post_likers, (chat_id, owner_id, post_id, username)
+        if position is None:
+            return
         user_states.pop(chat_id, None)
 
+        response = "Собираю лайки..."
+        yield 'send', response, {'reply_markup': types.ReplyKeyboardRemove()}
+        yield 'report', response, "Начало сбора лайков"
+        yield from queue_notice(position)
+
     else:
         response = "Выбери действие:"
-        bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
-        send_report_to_owner(chat_id, username, response, "Неизвестная команда")
+        yield 'send', response, {'reply_markup': main_menu_keyboard()}
+        yield 'report', response, "Неизвестная команда"
+
+
+def document_dialog(chat_id, username, document):
+    """Файл со списком профилей для массовой проверки; действия — как у text_dialog."""
+    if user_states.get(chat_id, {}).get('step') != 'awaiting_bulk_users':
+        yield 'send', "Файлы принимаются только для массовой проверки.", {'reply_markup': main_menu_keyboard()}
+        return
+    if document.file_size and document.file_size > BULK_FILE_LIMIT:
+        yield 'send', "Файл слишком большой, пришли список покороче.", {}
+        return
+
+    text = yield 'download', document.file_id
+    if text is None:
+        yield 'send', "Не удалось скачать файл, попробуй ещё раз.", {}
+        return
+    yield from bulk_dialog(chat_id, username, text)
+
+
+def bulk_dialog(chat_id, username, text):
+    names = extract_screen_names(text)
+    if not names:
+        response = "Не нашёл ни одной ссылки на профиль."
+        yield 'send', response, {}
+        yield 'report', response, "Ошибка массовой проверки"
+        return
+
+    group_id = user_states[chat_id]['group_id']
+    position = yield 'submit', analyze_bulk_activity, (chat_id, group_id, names[:BULK_MAX_USERS], username)
+    if position is None:
+        return
+    user_states.pop(chat_id, None)
+
+    response = BULK_STARTED_TEXT
+    if len(names) > BULK_MAX_USERS:
+        response += f"\n\nПрофилей больше {BULK_MAX_USERS} — проверю первые {BULK_MAX_USERS}."
+    yield 'send', response, {'reply_markup': types.ReplyKeyboardRemove()}
+    yield 'report', response, f"Начало массовой проверки ({len(names)} профилей)"
+    yield from queue_notice(position)
+
+
+def queue_notice(position):
+    if position:
+        yield 'send', f"⏳ Все обработчики заняты. Ты в очереди, позиция {position}", {}
+
+
+def run_dialog(dialog, chat_id, username):
+    """Исполняет действия диалога синхронным ботом; задачи уходят в пул через submit_long_job."""
+    result = None
+    try:
+        while True:
+            action, *args = dialog.send(result)
+            result = None
+            if action == 'send':
+                bot.send_message(chat_id, args[0], **args[1])
+            elif action == 'report':
+                send_report_to_owner(chat_id, username, *args)
+            elif action == 'resolve':
+                result = resolve_vk_id(args[0])
+            elif action == 'download':
+                result = download_text_file(args[0])
+            elif action == 'submit':
+                result = submit_long_job(chat_id, username, args[0], *args[1])
+    except StopIteration:
+        pass
+
+
+def download_text_file(file_id):
+    try:
+        file_info = bot.get_file(file_id)
+        return bot.download_file(file_info.file_path).decode('utf-8', errors='ignore')
+    except Exception as e:
+        log_error("Ошибка загрузки файла", e)
+        return None
+
+
+# === ОСНОВНОЙ ОБРАБОТЧИК ТЕКСТА ===
+@bot.message_handler(content_types=['text'])
+@chat_serialized
+def handle_text(message):
+    username = message.from_user.username if message.from_user.username else "не указан"
+    run_dialog(text_dialog(message.chat.id, username, message.text.strip()), message.chat.id, username)
+
+
+@bot.message_handler(content_types=['document'])
+@chat_serialized
+def handle_document(message):
+    username = message.from_user.username if message.from_user.username else "не указан"
+    run_dialog(document_dialog(message.chat.id, username, message.document), message.chat.id, username)
+
+
+# === Тексты отчётов ===
+def build_likers_report(count, users, link):
+    report = f"<b>📊 Лайкнули пост: {count} человек</b>\n\n"
+    report += f"<b>Ссылка на пост:</b>\n{link}\n\n"
+    user_list = []
+
+    for i, user in enumerate(users[:50], 1):
+        row = liker_row(user)
+        user_list.append(f"{i}. <a href='{row['link']}'>{html.escape(row['name'])}</a>")
+
+    report += "<b>Список лайкнувших:</b>\n" + "\n".join(user_list)
+    if count > 50:
+        report += f"\n\n...и еще {count - 50} человек"
+    return report
+
+
+def build_user_info(user_id, user_vk, group_vk):
+    """Заголовок отчёта из ответов users.get и groups.getById (None — если запрос не удался)."""
+    try:
+        user_name = f"{user_vk[0]['first_name']} {user_vk[0]['last_name']}"
+        user_link = f"https://vk.com/id{user_id}"
+    except (TypeError, IndexError, KeyError):
+        user_name = "Пользователь"
+        user_link = "—"
+
+    try:
+        group_name = group_vk[0]["name"]
+    except (TypeError, IndexError, KeyError):
+        group_name = "Группа"
+
+    return {"name": user_name, "link": user_link, "group_name": group_name}
+
+
+def build_posts_data(group_id, posts, like_infos):
+    posts_data = []
+    for post, info in zip(posts, like_infos):
+        # info = None — проверка не удалась (ошибка VK после всех повторов), а не «нет лайка»
+        checked = bool(info)
+        posts_data.append({
+            "date": datetime.datetime.fromtimestamp(post['date']).strftime("%d.%m.%Y %H:%M"),
+            "link": f"https://vk.com/wall{group_id}_{post['id']}",
+            "liked": checked and bool(info.get('liked', False)),
+            "reposted": checked and bool(info.get('copied', False)),
+            "checked": checked,
+        })
+    return posts_data
+
+
+def activity_mark(item, key, yes="да", no="нет", unknown="не проверен"):
+    """Значение ячейки лайка/репоста с учётом непроверенных постов."""
+    if not item.get("checked", True):
+        return unknown
+    return yes if item[key] else no
+
+
+def build_activity_report(posts_data, earlier=()):
+    liked = [f"• Пост от {p['date']} ({p['link']})" for p in posts_data if p['liked']]
+    reposted = [f"• Пост от {p['date']} ({p['link']})" for p in posts_data if p['reposted']]
+    total_likes = len(liked)
+    total_reposts = len(reposted)
+    unchecked = sum(1 for p in posts_data if not p.get('checked', True))
+    checked = len(posts_data) - unchecked
+
+    report = "<b>📊 Анализ завершён!</b>\n\n"
+    report += "<b>Статистика:</b>\n"
+    report += f"• Проверено постов: <b>{checked}</b>\n"
+    if unchecked:
+        report += f"• Не удалось проверить: <b>{unchecked}</b>\n"
+    report += f"• Лайков: <b>{total_likes}</b>\n"
+    report += f"• Репостов: <b>{total_reposts}</b>\n"
+    report += f"• Всего активности: <b>{total_likes + total_reposts}</b>\n"
+
+    if checked:
+        activity_percent = (total_likes + total_reposts) / checked * 100
+        report += f"• Процент активности: <b>{activity_percent:.1f}%</b>\n\n"
+    else:
+        report += "\n"
+
+    if liked:
+        report += f"<b>❤️ Лайкнутые посты ({total_likes}):</b>\n"
+        for item in liked[:10]:
+            report += f"{item}\n"
+        if len(liked) > 10:
+            report += f"...и еще {len(liked) - 10} постов\n\n"
+        else:
+            report += "\n"
+
+    if reposted:
+        report += f"<b>🔄 Репосты ({total_reposts}):</b>\n"
+        for item in reposted[:10]:
+            report += f"{item}\n"
+        if len(reposted) > 10:
+            report += f"...и еще {len(reposted) - 10} постов\n"
+
+    if earlier:
+        report += f"\n<b>🗂 В более ранних постах</b> (по сохранённым данным): {len(earlier)}\n"
+
+    if unchecked:
+        report += f"\n⚠️ {unchecked} постов не удалось проверить из-за ошибок VK — повтори анализ позже.\n"
+    elif not liked and not reposted:
+        report += "😴 Пользователь <b>ничего не лайкал и не репостил</b>."
+    return report
+
+
+def build_chunk_report(group_id, start, posts, like_infos):
+    """Промежуточный итог по порции постов, пока проверяются следующие."""
+    posts_data = build_posts_data(group_id, posts, like_infos)
+    liked = [p for p in posts_data if p['liked']]
+    reposted = [p for p in posts_data if p['reposted']]
+    unchecked = sum(1 for p in posts_data if not p['checked'])
+
+    report = f"📬 <b>Посты {start + 1}–{start + len(posts)}</b>: ❤️ {len(liked)}, 🔄 {len(reposted)}"
+    report += f", ❔ не проверено {unchecked}\n" if unchecked else "\n"
+    for p in liked[:10]:
+        report += f"• <a href='{p['link']}'>Пост от {p['date']}</a>\n"
+    if len(liked) > 10:
+        report += f"...и еще {len(liked) - 10}\n"
+    return report
 
 
 # === ФУНКЦИЯ: Кто лайкнул пост ===
+@metrics.timed('job_seconds')
 def get_post_likers(chat_id, owner_id, post_id, username):
     try:
-        likes = vk.likes.getList(
-            type='post',
-            owner_id=owner_id,
-            item_id=post_id,
-            count=1000,
-            extended=1,
-            fields='id,first_name,last_name'
-        )
-        users = likes.get('items', [])
+        pages = shared_post_likers(owner_id, post_id)
+        first_page = next(pages, None)
 
-        if not users:
+        if not first_page:
             response = "Никто не лайкнул этот пост"
             bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
             send_report_to_owner(chat_id, username, response, "Результат: нет лайков")
             return
 
-        count = len(users)
+        count, users = first_page
         
         # Подробный отчёт сообщением
         link_clean = f"https://vk.com/wall{owner_id}_{post_id}"
-        report = f"<b>📊 Лайкнули пост: {count} человек</b>\n\n"
-        report += f"<b>Ссылка на пост:</b>\n{link_clean}\n\n"
-        1
-        user_list = []
-        likers_data = []
-
-        for i, user in enumerate(users[:50], 1):
-            name = f"{user['first_name']} {user['last_name']}"
-            link = f"https://vk.com/id{user['id']}"
-            user_list.append(f"{i}. <a href='{link}'>{name}</a>")
-            likers_data.append({"name": name, "link": link})
-
-        report += "<b>Список лайкнувших:</b>\n" + "\n".join(user_list)
-        if count > 50:
-            report += f"\n\n...и еще {count - 50} человек"
-        
-        bot.send_message(chat_id, report, parse_mode="HTML", disable_web_page_preview=True)
+        report = build_likers_report(count, users, link_clean)
+        send_long_message(chat_id, report, disable_web_page_preview=True)
 
-        # Создаём и отправляем DOCX
+        # Создаём и отправляем файл, дочитывая остальные страницы по ходу
         post_info = {"link": link_clean}
-        docx_path = create_likers_docx(post_info, likers_data)
-
-        with open(docx_path, 'rb') as f:
-            bot.send_document(chat_id, f, caption=f"📎 Список лайкнувших ({count} чел.)")
+        fmt = report_formats.get(chat_id, REPORT_FORMAT)
+        filename, report_file = create_likers_report(fmt, post_info, stream_liker_rows(chat_id, users, pages, count))
 
-        os.remove(docx_path)
+        send_report_file(chat_id, (filename, report_file), f"📎 Список лайкнувших ({count} чел.)")
 
         bot.send_message(chat_id, "✅ Готово! Все данные отправлены.", reply_markup=main_menu_keyboard())
         send_report_to_owner(chat_id, username, report, f"Результат лайков поста ({count} человек)")
@@ -422,125 +2813,1141 @@ def get_post_likers(chat_id, owner_id, post_id, username):
             bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
             send_report_to_owner(chat_id, username, response, "Ошибка ВК API")
     except Exception as e:
-        print("Ошибка:", e)
+        log_error("Ошибка", e)
         response = "❌ Произошла ошибка при получении лайков"
         bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
         send_report_to_owner(chat_id, username, response, "Ошибка получения лайков")
 
 
 # === ФУНКЦИЯ: Анализ активности пользователя в группе ===
-def analyze_user_activity(chat_id, group_id, user_id, username):
+def fetch_user_activity(group_id, user_id, depth, progress=None):
+    """Данные для отчёта: (user_info, posts_data) или None, если постов нет."""
+    posts, like_infos = run_vk_plan(_deep_activity_plan(user_id, group_id, depth, progress=progress))
+    if not posts:
+        return None
+
+    # Получим данные пользователя и группы для заголовка
     try:
-        posts = vk.wall.get(owner_id=group_id, count=30)['items']
-        if not posts:
+        user_vk = cached('user', user_id, lambda: vk.users.get(user_ids=user_id, fields="first_name,last_name"))
+    except Exception as e:
+        log_error("Ошибка получения пользователя", e)
+        user_vk = None
+
+    try:
+        group_vk = cached('group', group_id, lambda: vk.groups.getById(group_id=-group_id))
+    except Exception as e:
+        log_error("Ошибка получения группы", e)
+        group_vk = None
+
+    user_info = build_user_info(user_id, user_vk, group_vk)
+    user_info['earlier'] = like_index.liked_posts(group_id, user_id, exclude={post['id'] for post in posts})
+    return user_info, build_posts_data(group_id, posts, like_infos)
+
+
+@metrics.timed('job_seconds')
+def analyze_user_activity(chat_id, group_id, user_id, username, depth):
+    try:
+        progress = ProgressMessage(chat_id, "Проверено постов")
+        activity = vk_flights.do(('activity', group_id, user_id, _depth_key(depth)),
+                                 lambda: fetch_user_activity(group_id, user_id, depth, progress))
+        if not activity:
+            response = "❌ Нет постов или доступ закрыт."
+            bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+            send_report_to_owner(chat_id, username, response, "Ошибка: нет постов")
+            return
+
+        user_info, posts_data = activity
+        progress.finish(f"✅ Проверено постов: {len(posts_data)}")
+
+        # Текстовый отчёт
+        report = build_activity_report(posts_data, user_info['earlier'])
+
+        send_long_message(chat_id, report, disable_web_page_preview=True)
+
+        # Генерация файла с отчётом
+        fmt = report_formats.get(chat_id, REPORT_FORMAT)
+        send_report_file(chat_id, create_activity_report(fmt, user_info, posts_data),
+                         f"📎 Подробный отчёт в формате {format_title(fmt)}")
+
+        bot.send_message(chat_id, "✅ Готово! Все данные отправлены.", reply_markup=main_menu_keyboard())
+        send_report_to_owner(chat_id, username, report, "Результат анализа активности")
+
+    except Exception as e:
+        log_error("Ошибка анализа", e)
+        response = "❌ Ошибка при анализе."
+        bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+        send_report_to_owner(chat_id, username, response, "Ошибка анализа")
+
+
+# === ФУНКЦИЯ: Массовая проверка активности ===
+BULK_COLUMNS = ("№", "VK ID", "Имя", "Ссылка", "Лайков", "Репостов", "Активность, %")
+USERS_GET_LIMIT = 1000  # user_ids в одном users.get
+
+
+def _bulk_plan(group_id, names, posts_count):
+    """
+    План массовой проверки: пачками определяет id профилей, один раз
+    выгружает лайкнувших и репостнувших по каждому посту группы.
+    Возвращает словарь с данными для матрицы или None, если постов нет.
+    """
+    chunks = [names[i:i + USERS_GET_LIMIT] for i in range(0, len(names), USERS_GET_LIMIT)]
+    calls = [('users.get', {'user_ids': ','.join(chunk), 'fields': 'screen_name'}) for chunk in chunks]
+    posts = vk_cache.get('wall', (group_id, posts_count))
+    if posts is VkCache.MISSING:
+        calls.append(('wall.get', {'owner_id': group_id, 'count': posts_count}))
+    calls.append(('groups.getById', {'group_id': -group_id}))
+
+    results = yield calls
+    group_vk = results.pop()
+    if posts is VkCache.MISSING:
+        wall = results.pop()
+        if wall is None:
+            raise RuntimeError("wall.get не вернул посты")
+        posts = wall.get('items', [])
+        vk_cache.set('wall', (group_id, posts_count), posts)
+    if not posts:
+        return None
+
+    users = {}
+    retry = []  # имена из пачек, которые users.get не принял целиком
+    for chunk, found in zip(chunks, results):
+        if found is None:
+            retry += chunk
+            continue
+        for user in found:
+            users[user['id']] = user
+            for key in (str(user['id']), f"id{user['id']}", user.get('screen_name', '')):
+                if key:
+                    vk_cache.set('screen_name', key.lower(), {'type': 'user', 'object_id': user['id']})
+
+    if retry:
+        resolved = yield [('utils.resolveScreenName', {'screen_name': name}) for name in retry]
+        ids = [r['object_id'] for r in resolved if r and r.get('type') == 'user']
+        if ids:
+            more = yield [('users.get', {'user_ids': ','.join(map(str, ids[i:i + USERS_GET_LIMIT]))})
+                          for i in range(0, len(ids), USERS_GET_LIMIT)]
+            for found in more:
+                for user in found or []:
+                    users[user['id']] = user
+
+    resolved_names = set()
+    for user in users.values():
+        resolved_names.update((str(user['id']), f"id{user['id']}", user.get('screen_name', '').lower()))
+    unresolved = [name for name in names if name not in resolved_names]
+
+    yield from _audience_plan(group_id, posts)
+    audiences = [_fresh_audience(group_id, post, track=False) for post in posts]
+
+    return {
+        'group_name': build_user_info(None, None, group_vk)['group_name'],
+        'posts': posts,
+        'users': list(users.values()),
+        'unresolved': unresolved,
+        'audiences': audiences,
+    }
+
+
+def activity_matrix(user_ids, audiences):
+    """
+    Считает, сколько постов каждый пользователь лайкнул и репостнул.
+    Матрица пользователи × посты строится векторно в NumPy (если он есть).
+    Посты без данных (None) не дают ни лайков, ни репостов; доля
+    активности в build_bulk_rows считается только по проверенным постам.
+    """
+    if np is not None:
+        ids = np.fromiter(user_ids, dtype=np.int64, count=len(user_ids))
+        liked = np.zeros((len(ids), len(audiences)), dtype=bool)
+        reposted = np.zeros((len(ids), len(audiences)), dtype=bool)
+        for j, audience in enumerate(audiences):
+            if audience:
+                liked[:, j] = np.isin(ids, np.frombuffer(audience['likes'], dtype=np.int64))
+                reposted[:, j] = np.isin(ids, np.frombuffer(audience['copies'], dtype=np.int64))
+        return liked.sum(axis=1).tolist(), reposted.sum(axis=1).tolist()
+
+    likes = [sum(1 for a in audiences if a and _contains(a['likes'], uid)) for uid in user_ids]
+    reposts = [sum(1 for a in audiences if a and _contains(a['copies'], uid)) for uid in user_ids]
+    return likes, reposts
+
+
+def build_bulk_rows(data):
+    """Строки отчёта, отсортированные по убыванию активности."""
+    users = data['users']
+    likes, reposts = activity_matrix([u['id'] for u in users], data['audiences'])
+    total = sum(1 for a in data['audiences'] if a is not None) or 1
+    rows = [
+        (user['id'], f"{user['first_name']} {user['last_name']}", f"https://vk.com/id{user['id']}",
+         liked, reposted, round((liked + reposted) / total * 100, 1))
+        for user, liked, reposted in zip(users, likes, reposts)
+    ]
+    rows.sort(key=lambda row: (-row[5], row[1]))
+    return rows
+
+
+def build_bulk_report(data, rows):
+    total_posts = len(data['posts'])
+    missing = sum(1 for a in data['audiences'] if a is None)
+    active = sum(1 for row in rows if row[5] > 0)
+
+    report = "<b>📊 Массовая проверка завершена!</b>\n\n"
+    report += f"<b>Группа:</b> {html.escape(data['group_name'])}\n"
+    report += f"• Проверено постов: <b>{total_posts - missing}</b>\n"
+    report += f"• Профилей: <b>{len(rows)}</b>\n"
+    report += f"• Проявляли активность: <b>{active}</b>\n"
+    report += f"• Без активности: <b>{len(rows) - active}</b>\n"
+    if missing:
+        report += f"• Не удалось проверить постов (лайки скрыты или ошибка VK): <b>{missing}</b>\n"
+    if data['unresolved']:
+        report += f"• Не найдено профилей: <b>{len(data['unresolved'])}</b>\n"
+
+    if rows:
+        report += "\n<b>🏆 Самые активные:</b>\n"
+        for i, row in enumerate(rows[:10], 1):
+            report += f"{i}. <a href='{row[2]}'>{html.escape(row[1])}</a> — {row[5]}%\n"
+    return report
+
+
+@metrics.timed('report_build_seconds')
+def create_bulk_report(fmt, rows):
+    # DOCX для таблицы на сотни строк неудобен — отдаём сортируемую таблицу
+    if fmt not in ("csv", "csv.gz", "xlsx"):
+        fmt = "xlsx" if "XLSX" in REPORT_FORMATS else "csv"
+    return fmt, create_table_report(fmt, BULK_COLUMNS, ((i, *row) for i, row in enumerate(rows, 1)), "Массовая_проверка")
+
+
+@metrics.timed('job_seconds')
+def analyze_bulk_activity(chat_id, group_id, names, username):
+    try:
+        data = run_vk_plan(_bulk_plan(group_id, names, BULK_POSTS))
+        if not data:
             response = "❌ Нет постов или доступ закрыт."
             bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
             send_report_to_owner(chat_id, username, response, "Ошибка: нет постов")
             return
 
-        # Получим данные пользователя и группы для заголовка
+        rows = build_bulk_rows(data)
+        report = build_bulk_report(data, rows)
+        send_long_message(chat_id, report, disable_web_page_preview=True)
+
+        fmt, report_file = create_bulk_report(report_formats.get(chat_id, REPORT_FORMAT), rows)
+        send_report_file(chat_id, report_file, f"📎 Активность профилей ({format_title(fmt)})")
+
+        bot.send_message(chat_id, "✅ Готово! Все данные отправлены.", reply_markup=main_menu_keyboard())
+        send_report_to_owner(chat_id, username, report, f"Результат массовой проверки ({len(rows)} профилей)")
+
+    except Exception as e:
+        log_error("Ошибка массовой проверки", e)
+        response = "❌ Ошибка при массовой проверке."
+        bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+        send_report_to_owner(chat_id, username, response, "Ошибка массовой проверки")
+
+
+# === ФУНКЦИЯ: Рейтинг активности группы ===
+LEADERBOARD_TOP = 20  # мест в сообщении; полный список — в файле
+LEADERBOARD_COLUMNS = ("Место", "VK ID", "Имя", "Ссылка", "Лайков", "Репостов", "Всего")
+
+
+class Leaderboard:
+    """
+    Рейтинг группы: множества лайкнувших и репостнувших по каждому посту
+    и суммарные счётчики по пользователям. При обновлении перевыгружаются
+    только новые посты и свежие посты, у которых изменились счётчики
+    в wall.get, — их вклад вычитается и добавляется заново.
+    """
+
+    def __init__(self):
+        self.posts = {}  # post_id -> {'counts': (лайки, репосты) из wall.get, 'likes': array, 'copies': array}
+        self.likes = Counter()
+        self.reposts = Counter()
+        self.group_name = None
+
+    def needs_refresh(self, post, now):
+        known = self.posts.get(post['id'])
+        if known is None:
+            return True
+        if known['counts'] == _post_counts(post):
+            return False
+        return now - post.get('date', 0) < LEADERBOARD_HOT_DAYS * 24 * 60 * 60
+
+    def merge(self, post, audience):
+        """Заменяет вклад поста; audience=None — данные недоступны (лайки скрыты)."""
+        self._drop(post['id'])
+        entry = {
+            # недоступный пост помечаем счётчиками, которые не совпадут с wall.get
+            'counts': _post_counts(post) if audience else None,
+            'likes': audience['likes'] if audience else array('q'),
+            'copies': audience['copies'] if audience else array('q'),
+        }
+        self.posts[post['id']] = entry
+        self.likes.update(entry['likes'])
+        self.reposts.update(entry['copies'])
+
+    def keep(self, post_ids):
+        """Убирает посты, выпавшие из окна последних постов."""
+        for post_id in [p for p in self.posts if p not in post_ids]:
+            self._drop(post_id)
+
+    def _drop(self, post_id):
+        entry = self.posts.pop(post_id, None)
+        if entry is None:
+            return
+        self.likes.subtract(entry['likes'])
+        self.reposts.subtract(entry['copies'])
+        for counter, ids in ((self.likes, entry['likes']), (self.reposts, entry['copies'])):
+            for user_id in ids:
+                if counter[user_id] <= 0:
+                    del counter[user_id]
+
+    def top(self, limit):
+        """[(user_id, лайков, репостов)] по убыванию суммарной активности."""
+        users = self.likes.keys() | self.reposts.keys()
+        best = sorted(users, key=lambda u: (-(self.likes[u] + self.reposts[u]), -self.likes[u], u))
+        return [(u, self.likes[u], self.reposts[u]) for u in best[:limit]]
+
+
+def _leaderboard_plan(group_id, posts_count, limit):
+    """
+    План обновления рейтинга: wall.get последних постов, перевыгрузка
+    лайкнувших только для устаревших постов, имена для первых limit мест.
+    """
+    board = vk_cache.get('leaderboard', group_id)
+    if board is VkCache.MISSING:
+        board = Leaderboard()
+
+    calls = [('wall.get', {'owner_id': group_id, 'count': posts_count})]
+    if board.group_name is None:
+        calls.append(('groups.getById', {'group_id': -group_id}))
+    results = yield calls
+    if results[0] is None:
+        raise RuntimeError("wall.get не вернул посты")
+    posts = results[0].get('items', [])
+    vk_cache.set('wall', (group_id, posts_count), posts)
+    if len(results) > 1:
+        board.group_name = build_user_info(None, None, results[1])['group_name']
+    if not posts:
+        return None
+
+    now = time.time()
+    stale = [post for post in posts if board.needs_refresh(post, now)]
+    yield from _audience_plan(group_id, stale, force={post['id'] for post in stale if post['id'] in board.posts})
+    for post in stale:
+        board.merge(post, _fresh_audience(group_id, post, track=False))
+    board.keep({post['id'] for post in posts})
+    vk_cache.set('leaderboard', group_id, board)
+
+    top = board.top(limit)
+    ids = [user_id for user_id, _, _ in top]
+    found = yield [('users.get', {'user_ids': ','.join(map(str, ids[i:i + USERS_GET_LIMIT]))})
+                   for i in range(0, len(ids), USERS_GET_LIMIT)]
+    names = {user['id']: f"{user['first_name']} {user['last_name']}" for chunk in found for user in chunk or []}
+
+    return {
+        'group_name': board.group_name,
+        'posts': len(posts),
+        'refreshed': len(stale),
+        'hidden': sum(1 for entry in board.posts.values() if entry['counts'] is None),
+        'rows': [(user_id, names.get(user_id, f"id{user_id}"), f"https://vk.com/id{user_id}", liked, reposted, liked + reposted)
+                 for user_id, liked, reposted in top],
+    }
+
+
+def build_leaderboard_report(data):
+    report = "<b>🏆 Рейтинг активности группы</b>\n\n"
+    report += f"<b>Группа:</b> {html.escape(data['group_name'])}\n"
+    report += f"• Постов в рейтинге: <b>{data['posts']}</b>\n"
+    report += f"• Обновлено при этом запросе: <b>{data['refreshed']}</b>\n"
+    if data['hidden']:
+        report += f"• Постов со скрытыми лайками: <b>{data['hidden']}</b>\n"
+
+    if not data['rows']:
+        return report + "\nНикто ещё не проявлял активность."
+    report += "\n"
+    for i, row in enumerate(data['rows'][:LEADERBOARD_TOP], 1):
+        report += f"{i}. <a href='{row[2]}'>{html.escape(row[1])}</a> — ❤️ {row[3]} 🔁 {row[4]}\n"
+    return report
+
+
+@metrics.timed('report_build_seconds')
+def create_leaderboard_report(fmt, rows):
+    if fmt not in ("csv", "csv.gz", "xlsx"):
+        fmt = "xlsx" if "XLSX" in REPORT_FORMATS else "csv"
+    return fmt, create_table_report(fmt, LEADERBOARD_COLUMNS, ((i, *row) for i, row in enumerate(rows, 1)), "Рейтинг_группы")
+
+
+@metrics.timed('job_seconds')
+def group_leaderboard(chat_id, group_id, username):
+    try:
+        data = vk_flights.do(('leaderboard', group_id),
+                             lambda: run_vk_plan(_leaderboard_plan(group_id, LEADERBOARD_POSTS, BULK_MAX_USERS)))
+        if not data:
+            response = "❌ Нет постов или доступ закрыт."
+            bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+            send_report_to_owner(chat_id, username, response, "Ошибка: нет постов")
+            return
+
+        report = build_leaderboard_report(data)
+        send_long_message(chat_id, report, disable_web_page_preview=True)
+
+        if len(data['rows']) > LEADERBOARD_TOP:
+            fmt, report_file = create_leaderboard_report(report_formats.get(chat_id, REPORT_FORMAT), data['rows'])
+            send_report_file(chat_id, report_file, f"📎 Полный рейтинг ({format_title(fmt)})")
+
+        bot.send_message(chat_id, "✅ Готово!", reply_markup=main_menu_keyboard())
+        send_report_to_owner(chat_id, username, report, "Результат рейтинга группы")
+
+    except Exception as e:
+        log_error("Ошибка рейтинга", e)
+        response = "❌ Ошибка при составлении рейтинга."
+        bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+        send_report_to_owner(chat_id, username, response, "Ошибка рейтинга группы")
+
+
+# === АСИНХРОННЫЙ РЕЖИМ ===
+class AsyncVkApi:
+    """
+    Асинхронный клиент VK API: все запросы идут через одну
+    aiohttp-сессию с пулом keep-alive соединений, токены и лимиты
+    частоты берутся из общего VkTokenPool.
+    """
+    API_URL = 'https://api.vk.com/method/'
+
+    def __init__(self, pool, api_version, pool_size=100):
+        self.pool = pool
+        self.api_version = api_version
+        self.pool_size = pool_size
+        self.session = None
+
+    async def method(self, method, values=None, raw=False):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+
+        values = dict(values or {})
+        data = {
+            key: ','.join(map(str, value)) if isinstance(value, (list, tuple)) else value
+            for key, value in values.items()
+        }
+        data['v'] = self.api_version
+
+        tried = []
+        while True:
+            token = self.pool.pick(exclude=tried)
+            try:
+                with metrics.timer('vk_request_seconds', method=method):
+                    return await self._call(token, method, values, data, raw)
+            except ApiError as e:
+                tried.append(token)
+                if not self.pool.report_error(token, e) or len(tried) >= len(self.pool.tokens):
+                    raise
+            finally:
+                self.pool.release(token)
+
+    async def _call(self, token, method, values, data, raw):
+        data = dict(data, access_token=token.token)
+        attempt = 0
+        while True:
+            await token.limiter.acquire_async()
+            async with self.session.post(self.API_URL + method, data=data) as resp:
+                response = await resp.json(content_type=None)
+
+            if 'error' not in response:
+                return response if raw else response['response']
+            error = ApiError(self, method, values, raw, response['error'])
+            metrics.inc('vk_errors_total', method=method, code=error.code)
+            if error.code not in VK_RETRY_CODES or attempt >= VK_MAX_RETRIES:
+                raise error
+            await asyncio.sleep(token.limiter.retry_delay(error, attempt))
+            attempt += 1
+
+    def get_api(self):
+        return AsyncVkApiMethod(self)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class AsyncVkApiMethod:
+    """Позволяет писать await avk.likes.isLiked(...) как в vk_api."""
+
+    def __init__(self, vk, method=None):
+        self._vk = vk
+        self._method = method
+
+    def __getattr__(self, name):
+        return AsyncVkApiMethod(self._vk, f"{self._method}.{name}" if self._method else name)
+
+    def __call__(self, **kwargs):
+        return self._vk.method(self._method, kwargs)
+
+
+async_bot = None
+avk_session = None
+avk = None
+async_chat_locks = {}  # chat_id -> [asyncio.Lock, число ожидающих сообщений]
+async_job_slots = None
+
+
+async def async_vk_execute_batch(calls):
+    """Как vk_execute_batch, но пачки по 25 вызовов уходят в VK параллельно."""
+    chunks = _execute_chunks(calls)
+    results = await asyncio.gather(*(_async_execute_chunk(chunk) for chunk in chunks))
+    return [item for items in results for item in items]
+
+
+async def _async_execute_chunk(chunk):
+    items = [None] * len(chunk)
+    todo = list(range(len(chunk)))
+    for attempt in range(VK_MAX_RETRIES + 1):
         try:
-            user_info_vk = vk.users.get(user_ids=user_id, fields="first_name,last_name")[0]
-            user_name = f"{user_info_vk['first_name']} {user_info_vk['last_name']}"
-            user_link = f"https://vk.com/id{user_id}"
-        except:
-            user_name = "Пользователь"
-            user_link = "—"
+            response = await avk_session.method('execute', {'code': _execute_code([chunk[i] for i in todo])}, raw=True)
+        except Exception as e:
+            log_error("Ошибка execute", e)
+            break
+        todo = _merge_execute_items(items, todo, response)
+        if not todo or attempt == VK_MAX_RETRIES:
+            break
+        await asyncio.sleep(vk_backoff(_execute_retry_error(response), attempt))
+    return items
+
+
+async def async_run_vk_plan(plan):
+    """
+    Как run_vk_plan, но шаги плана (кэш, локальный индекс на SQLite, разбор
+    ответов) выполняются в пуле потоков, а event loop только ждёт VK.
+    """
+    calls, done = await asyncio.to_thread(_plan_step, plan, None)
+    while not done:
+        results = await async_vk_execute_batch(calls)
+        calls, done = await asyncio.to_thread(_plan_step, plan, results)
+    return calls
+
+
+def _plan_step(plan, results):
+    """Продвигает план на шаг: (вызовы, False) или (итог плана, True)."""
+    try:
+        return (next(plan) if results is None else plan.send(results)), False
+    except StopIteration as stop:
+        return stop.value, True
+
+
+async def async_iter_post_likers(owner_id, post_id):
+    page = await avk.likes.getList(**_likers_page_params(owner_id, post_id, 0))
+    total = page.get('count', 0)
+    items = page.get('items', [])
+    if not items:
+        return
+    yield total, items
+
+    for offsets in _likers_offset_batches(total):
+        calls = [('likes.getList', _likers_page_params(owner_id, post_id, offset)) for offset in offsets]
+        for offset, page in zip(offsets, await async_vk_execute_batch(calls)):
+            if page is None:
+                page = await avk.likes.getList(**_likers_page_params(owner_id, post_id, offset))
+            if page.get('items'):
+                yield total, page['items']
+
+
+class AsyncPageBroadcast(PageBroadcast):
+    """Асинхронный вариант PageBroadcast."""
+
+    def __init__(self, source):
+        super().__init__(source)
+        self.fetch_lock = asyncio.Lock()
 
+    async def read(self, reader):
         try:
-            group_info = vk.groups.getById(group_id=-group_id)[0]
-            group_name = group_info["name"]
-        except:
-            group_name = "Группа"
+            while True:
+                page = self._take(reader)
+                if page is None:
+                    return
+                if page is self.MISSING:
+                    async with self.fetch_lock:
+                        if not self._loaded(reader):
+                            try:
+                                self._append(await anext(self.source))
+                            except StopAsyncIteration:
+                                self._finish()
+                            except Exception as e:
+                                self._finish(e)
+                    continue
+                yield page
+        finally:
+            self.detach(reader)
+
+
+async_flights = {}  # key -> asyncio.Future
+
+
+async def async_single_flight(key, fetch):
+    """Асинхронный вариант SingleFlight.do: fetch — фабрика корутины."""
+    flight = async_flights.get(key)
+    if flight is not None:
+        vk_flights.shared += 1
+        return await asyncio.shield(flight)
+
+    flight = async_flights[key] = asyncio.get_running_loop().create_future()
+    try:
+        flight.set_result(await fetch())
+    except Exception as e:
+        flight.set_exception(e)
+    finally:
+        del async_flights[key]
+    return flight.result()
+
+
+async def async_shared_post_likers(owner_id, post_id):
+    key = (owner_id, post_id)
+    flight = likers_flights.get(key)
+    reader = flight.attach() if flight is not None else None
+    if reader is None:
+        flight = likers_flights[key] = AsyncPageBroadcast(async_iter_post_likers(owner_id, post_id))
+        reader = flight.attach()
+    else:
+        vk_flights.shared += 1
+    try:
+        async for page in flight.read(reader):
+            yield page
+    finally:
+        if (flight.finished or not flight.readers) and likers_flights.get(key) is flight:
+            del likers_flights[key]
+
+
+async def async_stream_liker_rows(chat_id, first_items, pages, total):
+    for user in first_items:
+        yield liker_row(user)
+    if len(first_items) >= total:
+        return
+
+    loaded, fetched = len(first_items), 1
+    page_count = math.ceil(total / LIKERS_PAGE_SIZE)
+    progress = AsyncProgressMessage(chat_id, "Загружено лайкнувших")
+    async for _, items in pages:
+        for user in items:
+            yield liker_row(user)
+        loaded += len(items)
+        fetched += 1
+        progress.update(loaded, total, f"Страниц: {fetched} из {page_count}")
+    await progress.finish(f"✅ Загружено {loaded} из {total}")
+
+
+def _iter_async(agen, loop):
+    """Даёт читать асинхронный генератор из потока, в котором строится файл отчёта."""
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
 
-        user_info = {"name": user_name, "link": user_link, "group_name": group_name}
 
-        # Собираем данные по постам
-        posts_data = []
-        liked = []
-        reposted = []
-        total_likes = total_reposts = 0
+class AsyncProgressMessage(ProgressMessage):
+    """
+    ProgressMessage для асинхронного режима. update() вызывается и из
+    синхронных планов запросов, поэтому правки уходят фоновыми задачами
+    строго по очереди; finish() дожидается их.
+    """
 
-        for post in posts:
-            post_id = post['id']
-            date_str = datetime.datetime.fromtimestamp(post['date']).strftime("%d.%m.%Y %H:%M")
-            link = f"https://vk.com/wall{group_id}_{post_id}"
+    def __init__(self, chat_id, title):
+        super().__init__(chat_id, title)
+        self.tail = None
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
 
-            try:
-                info = vk.likes.isLiked(user_id=user_id, type='post', owner_id=group_id, item_id=post_id)
-                has_like = bool(info.get('liked', False))
-                has_repost = bool(info.get('copied', False))
-            except:
-                has_like = has_repost = False
-
-            if has_like:
-                total_likes += 1
-                liked.append(f"• Пост от {date_str} ({link})")
-            if has_repost:
-                total_reposts += 1
-                reposted.append(f"• Пост от {date_str} ({link})")
-
-            posts_data.append({
-                "date": date_str,
-                "link": link,
-                "liked": has_like,
-                "reposted": has_repost
-            })
+    def deliver(self, text):
+        self._enqueue(async_send_long_message(self.chat_id, text, disable_web_page_preview=True))
 
-        # Текстовый отчёт
-        report = "<b>📊 Анализ завершён!</b>\n\n"
-        report += f"<b>Статистика:</b>\n"
-        report += f"• Проверено постов: <b>{len(posts)}</b>\n"
-        report += f"• Лайков: <b>{total_likes}</b>\n"
-        report += f"• Репостов: <b>{total_reposts}</b>\n"
-        report += f"• Всего активности: <b>{total_likes + total_reposts}</b>\n"
-
-        if posts:
-            activity_percent = (total_likes + total_reposts) / len(posts) * 100
-            report += f"• Процент активности: <b>{activity_percent:.1f}%</b>\n\n"
+    async def finish(self, text):
+        super().finish(text)
+        if self.tail is not None:
+            await self.tail
+
+    def _show(self, text):
+        self.last_update = time.time()
+        if text == self.text:
+            return
+        self.text = text
+        self._enqueue(self._show_async(text))
+
+    async def _show_async(self, text):
+        if self.message_id is None:
+            self.message_id = (await async_bot.send_message(self.chat_id, text)).message_id
         else:
-            report += "\n"
+            await async_bot.edit_message_text(text, self.chat_id, self.message_id)
 
-        if liked:
-            report += f"<b>❤️ Лайкнутые посты ({total_likes}):</b>\n"
-            for item in liked[:10]:
-                report += f"{item}\n"
-            if len(liked) > 10:
-                report += f"...и еще {len(liked) - 10} постов\n\n"
-            else:
-                report += "\n"
+    def _enqueue(self, coro):
+        if threading.get_ident() != self.loop_thread:
+            # update() из плана, который выполняется в пуле потоков
+            self.loop.call_soon_threadsafe(self._enqueue, coro)
+            return
+        self.tail = asyncio.ensure_future(self._after(self.tail, coro))
 
-        if reposted:
-            report += f"<b>🔄 Репосты ({total_reposts}):</b>\n"
-            for item in reposted[:10]:
-                report += f"{item}\n"
-            if len(reposted) > 10:
-                report += f"...и еще {len(reposted) - 10} постов\n"
+    @staticmethod
+    async def _after(previous, coro):
+        if previous is not None:
+            await previous
+        try:
+            await coro
+        except Exception as e:
+            log_error("Ошибка обновления прогресса", e)
 
-        if not liked and not reposted:
-            report += "😴 Пользователь <b>ничего не лайкал и не репостил</b>."
 
-        bot.send_message(chat_id, report, parse_mode="HTML", disable_web_page_preview=True)
+async def async_send_long_message(chat_id, text, reply_markup=None, **kwargs):
+    chunks = split_html(text)
+    for i, chunk in enumerate(chunks):
+        await async_bot.send_message(chat_id, chunk, parse_mode="HTML",
+                                     reply_markup=reply_markup if i == len(chunks) - 1 else None, **kwargs)
 
-        # Генерация DOCX
-        docx_path = create_activity_docx(user_info, posts_data)
 
-        with open(docx_path, 'rb') as f:
-            bot.send_document(chat_id, f, caption="📎 Подробный отчёт в формате DOCX")
+async def async_send_report_to_owner(chat_id, username, message_text, report_type):
+    send_report_to_owner(chat_id, username, message_text, report_type)
 
-        os.remove(docx_path)
 
-        bot.send_message(chat_id, "✅ Готово! Все данные отправлены.", reply_markup=main_menu_keyboard())
-        send_report_to_owner(chat_id, username, report, f"Результат анализа активности")
+async def async_send_report_file(chat_id, report, caption):
+    filename, report_file = report
+    with report_file, metrics.timer('report_upload_seconds'):
+        await async_bot.send_document(chat_id, report_file, caption=caption, visible_file_name=filename)
+
+
+def async_chat_serialized(handler):
+    """Сообщения одного чата обрабатываются по одному, разные чаты — параллельно."""
+    @functools.wraps(handler)
+    async def wrapper(message):
+        chat_id = message.chat.id
+        entry = async_chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                branch = await _state_call(handler_branch, message)
+                with metrics.timer('handler_seconds', branch=branch):
+                    await handler(message)
+        except Exception as e:
+            log_error("Ошибка задачи", e)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                async_chat_locks.pop(chat_id, None)
+    return wrapper
+
+
+@async_chat_serialized
+async def async_start_command(message):
+    response = START_TEXT
+    await async_bot.send_message(message.chat.id, response, parse_mode="HTML", reply_markup=main_menu_keyboard())
+
+    username = message.from_user.username if message.from_user.username else "не указан"
+    await async_send_report_to_owner(message.chat.id, username, response, "Команда /start")
+
+
+@async_chat_serialized
+async def async_stats_command(message):
+    if not is_owner(message.chat.id):
+        return
+    for chunk in split_text(build_stats_report()):
+        await async_bot.send_message(message.chat.id, chunk)
+
+
+@async_chat_serialized
+async def async_handle_text(message):
+    username = message.from_user.username if message.from_user.username else "не указан"
+    await async_run_dialog(text_dialog(message.chat.id, username, message.text.strip()), message.chat.id, username)
+
+
+@async_chat_serialized
+async def async_handle_document(message):
+    username = message.from_user.username if message.from_user.username else "не указан"
+    await async_run_dialog(document_dialog(message.chat.id, username, message.document), message.chat.id, username)
+
+
+async def async_run_dialog(dialog, chat_id, username):
+    """
+    Исполняет действия диалога через AsyncTeleBot. Очереди нет: задача
+    запускается, когда диалог ответил пользователю, и ждёт свободного места
+    в async_job_slots.
+    """
+    job = None
+    result = None
+    while True:
+        # шаги диалога читают и меняют user_states и настройки чата
+        effect, done = await _state_call(_plan_step, dialog, result)
+        if done:
+            break
+        action, *args = effect
+        result = None
+        if action == 'send':
+            await async_bot.send_message(chat_id, args[0], **args[1])
+        elif action == 'report':
+            await async_send_report_to_owner(chat_id, username, *args)
+        elif action == 'resolve':
+            result = await async_resolve_vk_id(args[0])
+        elif action == 'download':
+            result = await async_download_text_file(args[0])
+        elif action == 'submit':
+            job = args
+            result = 0
+    if job:
+        func, args = job
+        async with async_job_slots:
+            await ASYNC_JOBS[func](*args)
+
+
+async def _state_call(func, *args):
+    """Состояние в SQLite (STATE_DB) читаем и пишем в пуле потоков, чтобы не держать event loop."""
+    if not STATE_DB:
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
+
+
+async def async_resolve_vk_id(screen_name):
+    try:
+        screen_name = screen_name.strip()
+        resolved = await cached_async('screen_name', screen_name.lower(),
+                                      lambda: avk.utils.resolveScreenName(screen_name=screen_name))
+        return vk_id_from_resolved(resolved)
+    except Exception as e:
+        log_error("Ошибка определения id ВК", e)
+        return None
+
+
+async def async_download_text_file(file_id):
+    try:
+        file_info = await async_bot.get_file(file_id)
+        return (await async_bot.download_file(file_info.file_path)).decode('utf-8', errors='ignore')
+    except Exception as e:
+        log_error("Ошибка загрузки файла", e)
+        return None
+
+
+@metrics.timed('job_seconds')
+async def async_analyze_bulk_activity(chat_id, group_id, names, username):
+    try:
+        data = await async_run_vk_plan(_bulk_plan(group_id, names, BULK_POSTS))
+        if not data:
+            response = "❌ Нет постов или доступ закрыт."
+            await async_bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+            await async_send_report_to_owner(chat_id, username, response, "Ошибка: нет постов")
+            return
+
+        rows = await asyncio.to_thread(build_bulk_rows, data)
+        report = build_bulk_report(data, rows)
+        await async_send_long_message(chat_id, report, disable_web_page_preview=True)
+
+        fmt = await _state_call(report_formats.get, chat_id, REPORT_FORMAT)
+        fmt, report_file = await asyncio.to_thread(create_bulk_report, fmt, rows)
+        await async_send_report_file(chat_id, report_file, f"📎 Активность профилей ({format_title(fmt)})")
+
+        await async_bot.send_message(chat_id, "✅ Готово! Все данные отправлены.", reply_markup=main_menu_keyboard())
+        await async_send_report_to_owner(chat_id, username, report, f"Результат массовой проверки ({len(rows)} профилей)")
+
+    except Exception as e:
+        log_error("Ошибка массовой проверки", e)
+        response = "❌ Ошибка при массовой проверке."
+        await async_bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+        await async_send_report_to_owner(chat_id, username, response, "Ошибка массовой проверки")
+
+
+@metrics.timed('job_seconds')
+async def async_group_leaderboard(chat_id, group_id, username):
+    try:
+        data = await async_single_flight(('leaderboard', group_id),
+                                         lambda: async_run_vk_plan(_leaderboard_plan(group_id, LEADERBOARD_POSTS, BULK_MAX_USERS)))
+        if not data:
+            response = "❌ Нет постов или доступ закрыт."
+            await async_bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+            await async_send_report_to_owner(chat_id, username, response, "Ошибка: нет постов")
+            return
+
+        report = build_leaderboard_report(data)
+        await async_send_long_message(chat_id, report, disable_web_page_preview=True)
+
+        if len(data['rows']) > LEADERBOARD_TOP:
+            fmt = await _state_call(report_formats.get, chat_id, REPORT_FORMAT)
+            fmt, report_file = await asyncio.to_thread(create_leaderboard_report, fmt, data['rows'])
+            await async_send_report_file(chat_id, report_file, f"📎 Полный рейтинг ({format_title(fmt)})")
+
+        await async_bot.send_message(chat_id, "✅ Готово!", reply_markup=main_menu_keyboard())
+        await async_send_report_to_owner(chat_id, username, report, "Результат рейтинга группы")
+
+    except Exception as e:
+        log_error("Ошибка рейтинга", e)
+        response = "❌ Ошибка при составлении рейтинга."
+        await async_bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+        await async_send_report_to_owner(chat_id, username, response, "Ошибка рейтинга группы")
+
+
+@metrics.timed('job_seconds')
+async def async_get_post_likers(chat_id, owner_id, post_id, username):
+    try:
+        pages = async_shared_post_likers(owner_id, post_id)
+        first_page = await anext(pages, None)
+
+        if not first_page:
+            response = "Никто не лайкнул этот пост"
+            await async_bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+            await async_send_report_to_owner(chat_id, username, response, "Результат: нет лайков")
+            return
+
+        count, users = first_page
+        link_clean = f"https://vk.com/wall{owner_id}_{post_id}"
+        report = build_likers_report(count, users, link_clean)
+        await async_send_long_message(chat_id, report, disable_web_page_preview=True)
+
+        # Файл строится в отдельном потоке, страницы дочитываются в цикле событий
+        rows = _iter_async(async_stream_liker_rows(chat_id, users, pages, count), asyncio.get_running_loop())
+        fmt = await _state_call(report_formats.get, chat_id, REPORT_FORMAT)
+        report_file = await asyncio.to_thread(create_likers_report, fmt, {"link": link_clean}, rows)
+        await async_send_report_file(chat_id, report_file, f"📎 Список лайкнувших ({count} чел.)")
+
+        await async_bot.send_message(chat_id, "✅ Готово! Все данные отправлены.", reply_markup=main_menu_keyboard())
+        await async_send_report_to_owner(chat_id, username, report, f"Результат лайков поста ({count} человек)")
+
+    except ApiError as e:
+        if e.code == 15:
+            response = "❌ Лайки скрыты у этого поста"
+            report_type = "Ошибка: лайки скрыты"
+        else:
+            response = f"❌ Ошибка ВК: {e}"
+            report_type = "Ошибка ВК API"
+        await async_bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+        await async_send_report_to_owner(chat_id, username, response, report_type)
+    except Exception as e:
+        log_error("Ошибка", e)
+        response = "❌ Произошла ошибка при получении лайков"
+        await async_bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+        await async_send_report_to_owner(chat_id, username, response, "Ошибка получения лайков")
+
+
+async def async_fetch_user_activity(group_id, user_id, depth, progress=None):
+    # Обход стены, пользователь и группа запрашиваются одновременно
+    scan, user_vk, group_vk = await asyncio.gather(
+        async_run_vk_plan(_deep_activity_plan(user_id, group_id, depth, progress=progress)),
+        cached_async('user', user_id, lambda: avk.users.get(user_ids=user_id, fields="first_name,last_name")),
+        cached_async('group', group_id, lambda: avk.groups.getById(group_id=-group_id)),
+        return_exceptions=True
+    )
+    if isinstance(scan, Exception):
+        raise scan
+    posts, like_infos = scan
+    if not posts:
+        return None
+
+    user_info = build_user_info(
+        user_id,
+        None if isinstance(user_vk, Exception) else user_vk,
+        None if isinstance(group_vk, Exception) else group_vk
+    )
+
+    user_info['earlier'] = await asyncio.to_thread(
+        like_index.liked_posts, group_id, user_id, exclude={post['id'] for post in posts})
+    return user_info, build_posts_data(group_id, posts, like_infos)
+
+
+@metrics.timed('job_seconds')
+async def async_analyze_user_activity(chat_id, group_id, user_id, username, depth):
+    try:
+        progress = AsyncProgressMessage(chat_id, "Проверено постов")
+        activity = await async_single_flight(
+            ('activity', group_id, user_id, _depth_key(depth)), lambda: async_fetch_user_activity(group_id, user_id, depth, progress)
+        )
+        if not activity:
+            response = "❌ Нет постов или доступ закрыт."
+            await async_bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+            await async_send_report_to_owner(chat_id, username, response, "Ошибка: нет постов")
+            return
+
+        user_info, posts_data = activity
+        await progress.finish(f"✅ Проверено постов: {len(posts_data)}")
+        report = build_activity_report(posts_data, user_info['earlier'])
+        await async_send_long_message(chat_id, report, disable_web_page_preview=True)
+
+        fmt = await _state_call(report_formats.get, chat_id, REPORT_FORMAT)
+        report_file = await asyncio.to_thread(create_activity_report, fmt, user_info, posts_data)
+        await async_send_report_file(chat_id, report_file, f"📎 Подробный отчёт в формате {format_title(fmt)}")
+
+        await async_bot.send_message(chat_id, "✅ Готово! Все данные отправлены.", reply_markup=main_menu_keyboard())
+        await async_send_report_to_owner(chat_id, username, report, "Результат анализа активности")
 
     except Exception as e:
-        print("Ошибка анализа:", e)
+        log_error("Ошибка анализа", e)
         response = "❌ Ошибка при анализе."
-        bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
-        send_report_to_owner(chat_id, username, response, "Ошибка анализа")
+        await async_bot.send_message(chat_id, response, reply_markup=main_menu_keyboard())
+        await async_send_report_to_owner(chat_id, username, response, "Ошибка анализа")
+
+
+# задачи из text_dialog / document_dialog и их асинхронные версии
+ASYNC_JOBS = {
+    analyze_user_activity: async_analyze_user_activity,
+    get_post_likers: async_get_post_likers,
+    analyze_bulk_activity: async_analyze_bulk_activity,
+    group_leaderboard: async_group_leaderboard,
+}
+
+
+async def run_async():
+    """Запуск бота на asyncio: AsyncTeleBot + асинхронный клиент VK."""
+    global async_bot, avk_session, avk, async_job_slots
+
+    if aiohttp is None or AsyncTeleBot is None:
+        print("Ошибка: для BOT_MODE=async нужны пакеты aiohttp и pyTelegramBotAPI с async_telebot")
+        return
+
+    async_bot = AsyncTeleBot(TELEGRAM_TOKEN)
+    avk_session = AsyncVkApi(vk_session, vk_session.api_version)
+    avk = avk_session.get_api()
+    async_job_slots = asyncio.Semaphore(ASYNC_JOB_LIMIT)
+
+    async_bot.register_message_handler(async_start_command, commands=['start'])
+    async_bot.register_message_handler(async_stats_command, commands=['stats'])
+    async_bot.register_message_handler(async_handle_text, content_types=['text'])
+    async_bot.register_message_handler(async_handle_document, content_types=['document'])
+    try:
+        await async_bot.polling(non_stop=True)
+    finally:
+        await avk_session.close()
+
+
+# === РЕЖИМ WEBHOOK ===
+def update_chat_id(update):
+    """chat_id из JSON-обновления Telegram (0, если чата в нём нет)."""
+    for key in ('message', 'edited_message', 'channel_post', 'callback_query'):
+        item = update.get(key)
+        if item:
+            return (item.get('message') or item).get('chat', {}).get('id', 0)
+    return 0
+
+
+def process_update_json(body):
+    # TeleBot сам раскладывает обработчики по своему пулу потоков
+    bot.process_new_updates([types.Update.de_json(body)])
+
+
+def webhook_worker(updates, index=0):
+    """
+    Процесс-обработчик: получает от WebhookRouter обновления своих чатов.
+    Метрики у каждого процесса свои — отдаются на METRICS_PORT + 1 + index.
+    """
+    global METRICS_PORT
+    if METRICS_PORT:
+        METRICS_PORT += 1 + index
+        start_metrics_server()
+    while True:
+        body = updates.get()
+        try:
+            process_update_json(body)
+        except Exception as e:
+            log_error("Ошибка обработки обновления", e)
+
+
+class WebhookRouter:
+    """
+    Раздаёт обновления процессам-обработчикам по chat_id: все обновления
+    одного чата попадают в один процесс, где хранится состояние диалога.
+    С одним обработчиком обновления обрабатываются прямо в этом процессе.
+    Упавший процесс перезапускается при следующем обновлении его чатов.
+    """
+
+    def __init__(self, workers):
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue() for _ in range(workers)] if workers > 1 else []
+        self.processes = [None] * len(self.queues)
+        self.lock = threading.Lock()
+        if self.queues:
+            # лимит запросов к VK общий на токен — делим его между процессами
+            os.environ['VK_RPS'] = str(VK_RPS / workers)
+
+    def route(self, body):
+        if not self.queues:
+            process_update_json(body)
+            return
+        index = update_chat_id(json.loads(body)) % len(self.queues)
+        with self.lock:
+            process = self.processes[index]
+            if process is None or not process.is_alive():
+                process = self.context.Process(target=webhook_worker, args=(self.queues[index], index),
+                                               name=f"webhook-worker-{index}", daemon=True)
+                process.start()
+                self.processes[index] = process
+        self.queues[index].put(body)
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if self.path != WEBHOOK_PATH or (WEBHOOK_SECRET and secret != WEBHOOK_SECRET):
+            self.send_error(403)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+
+        # Telegram ждёт быстрый ответ, иначе повторит обновление — подтверждаем до обработки
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.wfile.flush()
+        try:
+            self.server.router.route(body)
+        except Exception as e:
+            log_error("Ошибка обработки обновления", e)
+
+    def log_message(self, format, *args):
+        pass  # не печатаем строку на каждое обновление
+
+
+def make_webhook_server(host=WEBHOOK_HOST, port=WEBHOOK_PORT, workers=WEBHOOK_WORKERS):
+    server = http.server.ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    server.router = WebhookRouter(workers)
+    return server
+
+
+def run_webhook():
+    server = make_webhook_server()
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+    print(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, обработчиков: {WEBHOOK_WORKERS}")
+    server.serve_forever()
+
+
+# === Локальная проверка webhook ===
+def fake_update(chat_id, text, update_id=None, username="tester"):
+    """Обновление с текстовым сообщением в том виде, в каком его присылает Telegram."""
+    update_id = update_id or int(time.time() * 1000)
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': username, 'username': username},
+        },
+    }
+
+
+def send_fake_updates(url, updates, secret=WEBHOOK_SECRET):
+    """Шлёт обновления на webhook так же, как Telegram; возвращает коды ответов."""
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    codes = []
+    for update in updates:
+        request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), headers=headers)
+        with urllib.request.urlopen(request, timeout=10) as response:
+            codes.append(response.status)
+    return codes
 
 
 # === Запуск ===
 if __name__ == '__main__':
-    print("✅ Бот запущен — отправляет результаты сообщениями и DOCX-файлами!")
-    bot.polling(none_stop=True, interval=0)
\ No newline at end of file
+    if sys.argv[1:2] == ['fake-update']:
+        # python two.py fake-update <chat_id> <текст> — сообщение на локальный webhook
+        url = f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+        print(send_fake_updates(url, [fake_update(int(sys.argv[2]), " ".join(sys.argv[3:]))]))
+        sys.exit()
+
+    print("✅ Бот запущен — отправляет результаты сообщениями и файлами!")
+    start_metrics_server()
+    if BOT_MODE == 'async':
+        asyncio.run(run_async())
+    elif BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        bot.polling(none_stop=True, interval=0)
\ No newline at end of file